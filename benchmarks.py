@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+
+from correlation import AVAILABLE_CORRELATION_ENGINES, corr_coeff, thresholding_chunks, thresholding_edges, thresholding_matrix
+from data_handler import DataHandler
+from data_loader import DataLoader, NCEP_NCAR
+import fullrun as fr
+import graph_analysis as ga
+import icosahedral_grid as ico
+import synthetic_data as sd
+
+import contextlib
+import datetime as dt
+import functools as ft
+import h5py
+import igraph as ig
+import io
+import json
+import numpy as np
+import os
+import platform
+import tempfile
+import time
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+# the icosahedral grids: 642, 2562 and 10242 (the grid of the paper) nodes
+DEFAULT_NUM_ITERATIONS = [3, 4]
+DEFAULT_WINDOW_LENGTHS = [90, 365]
+DEFAULT_NUM_WINDOWS = 32 # written, merged and loaded again
+DEFAULT_REPEAT = 3
+
+# a stage is slower than in the baseline if its best time is larger by both of these
+DEFAULT_REGRESSION_THRESHOLD = 0.2 # relative
+DEFAULT_REGRESSION_MIN_DIFFERENCE = 0.01 # seconds
+
+# two consecutive years, like the windows of fullrun.py
+BENCHMARK_YEARS = (2000, 2001)
+
+# the metrics of 'get_results' that are timed one by one
+FIELD_METRICS = ["degree-field", "teleconnectivity-field", "transitivity-field"]
+ARRAY_METRICS = ["global-transitivity"] + [ga.MODULARITY_PREFIX + name for name in sorted(ga.AVAILABLE_COMMUNITY_ALGORITHMS)]
+
+# the stages of a window, timed for each grid and window length
+WINDOW_STAGES = [
+    "corr-coeff",
+    "thresholding-matrix",
+    "thresholding-edges",
+] + [f"correlation-engine-{name}" for name in sorted(AVAILABLE_CORRELATION_ENGINES)] + [
+    "graph-adjacency",
+    "graph-edges",
+    "get-results",
+] + [f"metric-{name}" for name in FIELD_METRICS + ARRAY_METRICS]
+# the stages independent of the window length, timed for each grid
+GRID_STAGES = [
+    "remap",
+    "load-years",
+    "save-results",
+    "merge-results",
+    "post-processing",
+]
+ALL_STAGES = GRID_STAGES + WINDOW_STAGES
+
+
+def time_calls(func, *, repeat, setup=None):
+    """
+    wall times of 'repeat' calls of func(*setup()), the setup is not timed
+    and the progress output of both is hidden
+    """
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            args = () if setup is None else setup()
+            t0 = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - t0)
+    return times
+
+
+@contextlib.contextmanager
+def result_keys(*, arrays, fields):
+    # 'get_results' computes what is in these module variables (like the script modes of fullrun.py)
+    old_keys = ga.RESULT_ARRAYS, ga.RESULT_FIELDS
+    ga.RESULT_ARRAYS, ga.RESULT_FIELDS = list(arrays), list(fields)
+    try:
+        yield
+    finally:
+        ga.RESULT_ARRAYS, ga.RESULT_FIELDS = old_keys
+
+
+def open_data(data_directory, *, years=BENCHMARK_YEARS):
+    """a data loader for the years, the seasonality is removed with the daily means of these years only"""
+    data_info = {
+        "base-name"  : "air",
+        "time-length": NCEP_NCAR.time_length,
+        "grid-shape" : NCEP_NCAR.grid_shape,
+    }
+    with contextlib.redirect_stdout(io.StringIO()):
+        return DataLoader(
+            data_directory,
+            data_load_info=data_info,
+            preprocessing_begin_year=years[0],
+            preprocessing_end_year=years[-1],
+            remove_seasonality=True,
+            surrogates=False,
+            cache=False
+        )
+
+
+def open_grid(num_iterations, data_loader):
+    return ico.IcosahedralGrid(
+        num_iterations=num_iterations,
+        base_grid=data_loader.base_lon_lat,
+        num_t=data_loader.data_load_info["time-length"],
+        verb=0
+    )
+
+
+def remapped_years(data_loader, grid_obj, *, years=BENCHMARK_YEARS):
+    """the remapped (and deseasonalized) data of the years as one (days, nodes) array"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return np.concatenate([grid_obj.remap(data_loader.load(year)) for year in years])
+
+
+def window_graph(edges, grid_obj):
+    # like fullrun.compute_metrics
+    graph = ig.Graph(n=grid_obj.grid.shape[0], edges=edges.tolist())
+    graph.vs["lon_lat"] = grid_obj.grid
+    return graph
+
+
+def adjacency_graph(adjacency, grid_obj):
+    # like fullrun.py did before the edge lists
+    graph = ig.Graph.Adjacency(adjacency.tolist(), mode=ig.ADJ_UNDIRECTED)
+    graph.vs["lon_lat"] = grid_obj.grid
+    return graph
+
+
+def benchmark_date_pairs(num_windows, *, window_length):
+    begin_dates = np.datetime64(f"{BENCHMARK_YEARS[0]}-01-01") + np.arange(num_windows)
+    return np.stack([begin_dates, begin_dates + window_length], axis=1).astype(ga.NUMPY_DATE_TYPE)
+
+
+def write_results(filename, date_pairs, indices, *, field_shape, single_vals, fields):
+    ga.prepare_output_file(filename, date_pairs, field_shape, run_info=fr.DEFAULT_RUN_INFO)
+    for index in indices:
+        ga.save_results(
+            index, *date_pairs[index],
+            out_file_name=filename,
+            single_vals=single_vals,
+            fields=fields
+        )
+
+
+class Benchmarks(object):
+    """runs the stages and collects the timing records"""
+
+    def __init__(self, *, stages, repeat, percentage, scratch_directory, num_windows=DEFAULT_NUM_WINDOWS):
+        assert set(stages).issubset(ALL_STAGES), f"unknown stages {set(stages) - set(ALL_STAGES)}"
+        self.stages = stages
+        self.repeat = repeat
+        self.percentage = percentage
+        self.scratch_directory = scratch_directory
+        self.num_windows = num_windows
+        self.records = []
+
+    def time(self, stage, func, *, nodes, window_length=None, setup=None):
+        if stage not in self.stages:
+            return
+        print(f"{stage:<45s} {nodes:6d} nodes  {'' if window_length is None else window_length:>4} days ... ", end="")
+        times = time_calls(func, repeat=self.repeat, setup=setup)
+        self.records.append({
+            "stage"         : stage,
+            "nodes"         : nodes,
+            "window-length" : window_length,
+            "times"         : times,
+            "min"           : min(times),
+            "median"        : float(np.median(times)),
+        })
+        print(f"{min(times):10.4f} s (median {np.median(times):0.4f} s)")
+
+    def run_grid(self, data_loader, grid_obj, *, window_lengths):
+        nodes = grid_obj.grid.shape[0]
+        ga.ELNINO_MASK = None # it is cached for the grid
+        data = remapped_years(data_loader, grid_obj)
+        assert max(window_lengths) < len(data)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            raw_data = data_loader.load(BENCHMARK_YEARS[0])
+        self.time("remap", ft.partial(grid_obj.remap, raw_data), nodes=nodes)
+        del raw_data
+
+        data_handler = DataHandler(
+            data_loader.load,
+            num_t=data_loader.data_load_info["time-length"],
+            info="air-b",
+            base_grid_shape=data_loader.data_load_info["grid-shape"],
+            grid_style="icosahedral",
+            irregular_grid=grid_obj
+        )
+        def forget_years():
+            data_handler.loadedyears = [0, 0]
+            return BENCHMARK_YEARS
+        self.time("load-years", data_handler.loadYears, nodes=nodes, setup=forget_years)
+        del data_handler
+
+        for window_length in window_lengths:
+            single_vals, fields = self.run_window(data, grid_obj, window_length=window_length)
+
+        self.run_output(grid_obj, single_vals=single_vals, fields=fields, window_length=window_lengths[-1])
+
+    def run_window(self, data, grid_obj, *, window_length):
+        nodes = grid_obj.grid.shape[0]
+        window = data[:window_length]
+        timed = ft.partial(self.time, nodes=nodes, window_length=window_length)
+
+        timed("corr-coeff", ft.partial(corr_coeff, window))
+        with contextlib.redirect_stdout(io.StringIO()):
+            correlations = np.nan_to_num(np.abs(corr_coeff(window)))
+            adjacency = thresholding_matrix(correlations, self.percentage)
+            edges = thresholding_edges(correlations, self.percentage)
+        timed("thresholding-matrix", ft.partial(thresholding_matrix, correlations, self.percentage))
+        timed("thresholding-edges", ft.partial(thresholding_edges, correlations, self.percentage))
+        del correlations
+
+        for engine_name, engine_class in sorted(AVAILABLE_CORRELATION_ENGINES.items()):
+            def new_engine():
+                options = {"directory": self.scratch_directory} if engine_name == "out-of-core" else {}
+                engine = engine_class(window_length=window_length, **options)
+                # the day before, so the incremental engine does an update
+                engine.chunks(data[:window_length], 0)
+                return (engine,)
+            def correlate_and_threshold(engine):
+                chunks, num_nodes = engine.chunks(data[1 : window_length + 1], 1)
+                thresholding_chunks(chunks, num_nodes, self.percentage)
+                engine.close()
+            timed(f"correlation-engine-{engine_name}", correlate_and_threshold, setup=new_engine)
+
+        timed("graph-adjacency", ft.partial(adjacency_graph, adjacency, grid_obj))
+        del adjacency
+        graph = window_graph(edges, grid_obj)
+        timed("graph-edges", ft.partial(window_graph, edges, grid_obj))
+
+        get_results = ft.partial(ga.get_results, graph, unit_vectors=ga.link_unit_vectors(grid_obj))
+        timed("get-results", get_results)
+        for name in FIELD_METRICS + ARRAY_METRICS:
+            with result_keys(arrays=[name] if name in ARRAY_METRICS else [], fields=[name] if name in FIELD_METRICS else []):
+                timed(f"metric-{name}", get_results)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            return get_results()
+
+    def run_output(self, grid_obj, *, single_vals, fields, window_length):
+        nodes = grid_obj.grid.shape[0]
+        field_shape = grid_obj.grid.shape[:1]
+        date_pairs = benchmark_date_pairs(self.num_windows, window_length=window_length)
+        filenames = [os.path.join(self.scratch_directory, f"benchmark-{nodes}.{part}.hdf5") for part in ["save", "mpi-0", "mpi-1", "merged"]]
+        save_file_name, merge_file_names, merged_file_name = filenames[0], filenames[1:3], filenames[3]
+        write = ft.partial(write_results, field_shape=field_shape, single_vals=single_vals, fields=fields)
+
+        def prepare_save():
+            ga.prepare_output_file(save_file_name, date_pairs, field_shape, run_info=fr.DEFAULT_RUN_INFO)
+            return ()
+        def save():
+            for index, (begin_date, end_date) in enumerate(date_pairs):
+                ga.save_results(index, begin_date, end_date, out_file_name=save_file_name, single_vals=single_vals, fields=fields)
+        self.time("save-results", save, nodes=nodes, setup=prepare_save)
+
+        def prepare_merge():
+            # like the files of two mpi processes
+            half = len(date_pairs) // 2
+            write(merge_file_names[0], date_pairs, range(half))
+            write(merge_file_names[1], date_pairs, range(half, len(date_pairs)))
+            if os.path.exists(merged_file_name):
+                os.remove(merged_file_name)
+            return ()
+        self.time("merge-results", ft.partial(ga.merge_results, merge_file_names, out_file_name=merged_file_name, verbose=0), nodes=nodes, setup=prepare_merge)
+
+        if "post-processing" in self.stages:
+            try:
+                import data_post_processor as dpp
+            except ImportError as e: # plotting dependencies (matplotlib, basemap)
+                print(f"skipping post-processing, {e}")
+            else:
+                if not os.path.exists(merged_file_name):
+                    write(merged_file_name, date_pairs, range(len(date_pairs)))
+                self.time("post-processing", ft.partial(dpp.DataPostProcessor, merged_file_name, grid_obj=grid_obj), nodes=nodes)
+
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def run_benchmarks(*,
+                   data_directory,
+                   num_iterations_list=DEFAULT_NUM_ITERATIONS,
+                   window_lengths=DEFAULT_WINDOW_LENGTHS,
+                   stages=ALL_STAGES,
+                   repeat=DEFAULT_REPEAT,
+                   percentage=fr.DEFAULT_RUN_INFO["cut-off-percentage"],
+                   num_windows=DEFAULT_NUM_WINDOWS,
+                   scratch_directory=None):
+    """time the stages for each grid and window length, returns the records"""
+    data_loader = open_data(data_directory)
+    with tempfile.TemporaryDirectory(prefix=".benchmarks-", dir=scratch_directory) as tmp_directory:
+        benchmarks = Benchmarks(stages=stages, repeat=repeat, percentage=percentage, scratch_directory=tmp_directory, num_windows=num_windows)
+        for num_iterations in num_iterations_list:
+            grid_obj = open_grid(num_iterations, data_loader)
+            benchmarks.run_grid(data_loader, grid_obj, window_lengths=window_lengths)
+    return benchmarks.records
+
+
+def benchmark_info(info):
+    """the environment of the run and 'info'"""
+    return dict({
+        "date"    : dt.datetime.now().isoformat(sep=" ", timespec="seconds"),
+        "host"    : platform.node(),
+        "python"  : platform.python_version(),
+        "numpy"   : np.__version__,
+        "igraph"  : ig.__version__,
+        "h5py"    : h5py.__version__,
+        "cpus"    : os.cpu_count(),
+    }, **info)
+
+
+def result_key(record):
+    return (record["stage"], record["nodes"], record["window-length"])
+
+
+def compare_results(records, baseline_records, *,
+                    threshold=DEFAULT_REGRESSION_THRESHOLD,
+                    min_difference=DEFAULT_REGRESSION_MIN_DIFFERENCE):
+    """(record, baseline record, ratio of the best times, is a regression) of the stages in both"""
+    baseline = {result_key(record): record for record in baseline_records}
+    comparisons = []
+    for record in records:
+        baseline_record = baseline.get(result_key(record))
+        if baseline_record is None:
+            continue
+        difference = record["min"] - baseline_record["min"]
+        is_regression = difference > threshold * baseline_record["min"] and difference > min_difference
+        comparisons.append((record, baseline_record, record["min"] / baseline_record["min"], is_regression))
+    return comparisons
+
+
+def print_comparison(comparisons):
+    print(f"{'stage':<45s} {'nodes':>6s} {'days':>4s} {'baseline':>10s} {'now':>10s} {'ratio':>6s}")
+    for record, baseline_record, ratio, is_regression in comparisons:
+        stage, nodes, window_length = result_key(record)
+        print(f"{stage:<45s} {nodes:6d} {'' if window_length is None else window_length:>4} "
+              f"{baseline_record['min']:10.4f} {record['min']:10.4f} {ratio:6.2f}" + (" REGRESSION" if is_regression else ""))
+
+
+if __name__ == "__main__":
+    # time the stages of fullrun.py and compare them with the results of an earlier run
+    import argcomplete, argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="time the stages of fullrun.py for several grids and window lengths "
+                                     "(on synthetic data by default) and compare them with a baseline")
+    parser.add_argument("-o", "--output", metavar="file",
+                        help="where the results are written (json), default: 'benchmarks.<date>.json'")
+    parser.add_argument("--baseline", metavar="file",
+                        help="results of an earlier run, exit with an error if a stage got slower")
+    parser.add_argument("--results", metavar="file",
+                        help="compare these results with the baseline instead of running the benchmarks")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, metavar="fraction",
+                        help="a stage regressed if its best time is this fraction slower than in the baseline, default: {}".format(DEFAULT_REGRESSION_THRESHOLD))
+    parser.add_argument("--min-difference", type=float, default=DEFAULT_REGRESSION_MIN_DIFFERENCE, metavar="seconds",
+                        help="and at least this much slower, default: {} s".format(DEFAULT_REGRESSION_MIN_DIFFERENCE))
+
+    parser.add_argument("--num-iterations", type=int, nargs="+", default=DEFAULT_NUM_ITERATIONS, metavar="N",
+                        help="the refinements of the icosahedral grid (5 is the grid of the paper), default: {}".format(" ".join(map(str, DEFAULT_NUM_ITERATIONS))))
+    parser.add_argument("--window-lengths", type=int, nargs="+", default=DEFAULT_WINDOW_LENGTHS, metavar="days",
+                        help="default: {}".format(" ".join(map(str, DEFAULT_WINDOW_LENGTHS))))
+    parser.add_argument("--stages", nargs="+", choices=ALL_STAGES, default=ALL_STAGES, metavar="stage",
+                        help="the stages that are timed, default: all of " + ", ".join(ALL_STAGES))
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, metavar="N",
+                        help="number of times each stage is timed, the best time is compared; default: {}".format(DEFAULT_REPEAT))
+    parser.add_argument("--num-windows", type=int, default=DEFAULT_NUM_WINDOWS, metavar="N",
+                        help="number of windows saved, merged and loaded, default: {}".format(DEFAULT_NUM_WINDOWS))
+
+    parser.add_argument("--data-directory", metavar="directory",
+                        help="the SAT data of {} and {}, default: synthetic data (see synthetic_data.py) in a temporary directory".format(*BENCHMARK_YEARS))
+    parser.add_argument("--scratch-directory", metavar="directory",
+                        help="a directory, where the temporary data should be saved")
+
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    if args.results is not None and args.baseline is None:
+        parser.error("--results needs a --baseline to compare with")
+    if args.repeat < 1:
+        parser.error("the number of repetitions has to be positive")
+    if not all(0 < window_length < len(BENCHMARK_YEARS) * NCEP_NCAR.time_length for window_length in args.window_lengths):
+        parser.error("the window lengths have to be between 1 and {} days".format(len(BENCHMARK_YEARS) * NCEP_NCAR.time_length - 1))
+
+    if args.results is not None:
+        with open(args.results, "r") as results_file:
+            results = json.load(results_file)
+    else:
+        if args.output is None:
+            args.output = "benchmarks.{}.json".format(dt.datetime.now().strftime("%Y-%m-%dT%H-%M-%S"))
+        if os.path.exists(args.output):
+            parser.error("'{}' exists already".format(args.output))
+
+        with contextlib.ExitStack() as stack:
+            data_directory = args.data_directory
+            if data_directory is None:
+                data_directory = stack.enter_context(tempfile.TemporaryDirectory(prefix=".benchmark-data-", dir=args.scratch_directory))
+                print("writing synthetic data ... ", end="")
+                sd.generate(data_directory, begin_year=BENCHMARK_YEARS[0], end_year=BENCHMARK_YEARS[-1], verbose=0)
+                print("done")
+
+            records = run_benchmarks(
+                data_directory=data_directory,
+                num_iterations_list=args.num_iterations,
+                window_lengths=args.window_lengths,
+                stages=args.stages,
+                repeat=args.repeat,
+                num_windows=args.num_windows,
+                scratch_directory=args.scratch_directory
+            )
+
+        results = {
+            "info" : benchmark_info({
+                "data"        : "synthetic" if args.data_directory is None else os.path.abspath(args.data_directory),
+                "repeat"      : args.repeat,
+                "num-windows" : args.num_windows,
+            }),
+            "results" : records,
+        }
+        print(f"writing '{args.output}' ... ", end="")
+        with open(args.output, "w") as out_file:
+            json.dump(results, out_file, indent=4)
+        print("done")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\ncomparing with '{args.baseline}' ({baseline['info']['date']}, {baseline['info']['host']}):")
+        comparisons = compare_results(results["results"], baseline["results"], threshold=args.threshold, min_difference=args.min_difference)
+        print_comparison(comparisons)
+        num_regressions = sum(is_regression for *_, is_regression in comparisons)
+        if num_regressions:
+            sys.exit(f"{num_regressions} stage(s) got slower than the baseline")
+        print("no regressions")
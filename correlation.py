@@ -1,6 +1,9 @@
 
 import numpy as np
+import abc
 import functools as ft
+import os
+import tempfile
 
 # always flush print output
 print = ft.partial(print, flush=True)
@@ -38,7 +41,424 @@ def corr_coeff(A,B = None):
     # Finally get corr coeff
     return numerator / denominator
 
-def thresholding_matrix(C, percentage, save_histo=False):
+
+def standardize(data):
+    """center and normalize the time series (columns), such that corr = standardize(A).T @ standardize(A)"""
+    data = np.asarray(data, dtype=np.float64)
+    assert data.ndim == 2
+    centered = data - data.mean(0)
+    centered /= np.sqrt((centered**2).sum(0))
+    return centered
+
+
+class CorrelationEngine(abc.ABC):
+    """
+    The base class every correlation engine should inherit from.
+
+    An engine is called with the data of a window and a running day number of
+    its first day and returns the correlation matrix. The thresholding only
+    needs the absolute correlations in chunks (see 'matrix_chunks'), which is
+    provided by 'chunks', so engines can avoid creating the full matrix.
+    """
+
+    @abc.abstractmethod
+    def __call__(self, data, first_day):
+        """return the correlation matrix of the window 'data' (days x nodes)"""
+
+    def close(self):
+        """free resources (e.g. files) held by the engine"""
+        pass
+
+    def chunks(self, data, first_day):
+        """return a function creating an iterator over the chunks of the absolute correlations and the number of nodes"""
+        C = self(data, first_day)
+        # in place, avoids two more copies of the full matrix
+        np.abs(C, out=C)
+        np.nan_to_num(C, copy=False)
+        return ft.partial(matrix_chunks, C), C.shape[0]
+
+
+class FullCorrelation(CorrelationEngine):
+    """recompute the correlation matrix of every window from scratch"""
+
+    def __init__(self, *, window_length):
+        self.window_length = window_length
+
+    def __call__(self, data, first_day):
+        # first_day is not needed here, but keeps the interface the same for all engines
+        assert data.shape[0] == self.window_length
+        return corr_coeff(np.asarray(data, dtype=np.float64)) # the data might be stored in single precision
+
+
+class SlidingCorrelation(CorrelationEngine):
+    """
+    keep running sums (per-node sums, sums of squares and the cross-product matrix)
+    of the current window and update them with the days that left and entered
+    the window instead of recomputing the whole correlation matrix
+
+    'first_day' has to be a running day number (without Feb 29), such that
+    consecutive windows can be recognized
+
+    in order to avoid the accumulation of rounding errors, the sums are
+    recomputed from scratch every 'refresh_interval' updates, after a jump or
+    whenever the windows do not overlap
+    """
+
+    def __init__(self, *, window_length, refresh_interval=365):
+        self.window_length = window_length
+        self.refresh_interval = refresh_interval
+        self.reset()
+
+    def reset(self):
+        self.first_day = None
+        self.window = None # copy of the current window, so the leaving days are known
+        self.offset = None # shift of the data, keeps the sums small and the cancellation harmless
+        self.sums = None
+        self.sums_of_squares = None
+        self.cross_products = None
+        self.num_updates = 0
+
+    def _initialize(self, data, first_day):
+        self.offset = data.mean(0)
+        shifted = data - self.offset
+        self.sums = shifted.sum(0)
+        self.sums_of_squares = (shifted**2).sum(0)
+        self.cross_products = np.dot(shifted.T, shifted)
+        self.num_updates = 0
+
+    def _update(self, data, shift):
+        if shift > 0:
+            removed = self.window[:shift] - self.offset
+            added = data[-shift:] - self.offset
+        else:
+            removed = self.window[shift:] - self.offset
+            added = data[:-shift] - self.offset
+        self.sums += added.sum(0) - removed.sum(0)
+        self.sums_of_squares += (added**2).sum(0) - (removed**2).sum(0)
+        # for shift == 1 these are the rank-one outer product updates
+        self.cross_products += np.dot(added.T, added)
+        self.cross_products -= np.dot(removed.T, removed)
+        self.num_updates += 1
+
+    def __call__(self, data, first_day):
+        data = np.asarray(data, dtype=np.float64)
+        assert data.ndim == 2
+        assert data.shape[0] == self.window_length
+
+        shift = None if self.first_day is None else first_day - self.first_day
+        if shift is None or abs(shift) >= self.window_length or self.num_updates >= self.refresh_interval:
+            self._initialize(data, first_day)
+        elif shift:
+            self._update(data, shift)
+        self.first_day = first_day
+        self.window = np.array(data) # copy, the data handler might overwrite its buffer
+
+        n = self.window_length
+        mean_products = np.outer(self.sums, self.sums) / n
+        numerator = self.cross_products - mean_products
+        del mean_products
+        ss = self.sums_of_squares - self.sums**2 / n
+        # the variance of a constant node is only a rounding residue, set it (and its covariances) to 0,
+        # so its correlations are nan and become 0 in the thresholding, as with 'corr_coeff'
+        constant = ss <= n * np.finfo(np.float64).eps * self.sums_of_squares
+        ss[constant] = 0.
+        numerator[constant, :] = 0.
+        numerator[:, constant] = 0.
+        denominator = np.sqrt(np.outer(ss, ss))
+        numerator /= denominator
+        return numerator
+
+
+def correlation_tiles(standardized, tile_size):
+    """
+    yield the absolute correlations of the standardized data in square tiles
+    (tile, i0, j0) with j0 <= i0, i.e. the blocks on and below the diagonal
+    """
+    num_nodes = standardized.shape[1]
+    for i0 in range(0, num_nodes, tile_size):
+        rows = standardized[:, i0 : i0 + tile_size]
+        for j0 in range(0, i0 + 1, tile_size):
+            tile = np.dot(rows.T, standardized[:, j0 : j0 + tile_size])
+            np.abs(tile, out=tile)
+            np.nan_to_num(tile, copy=False)
+            yield tile, i0, j0
+            del tile
+
+
+class TiledCorrelation(CorrelationEngine):
+    """
+    compute the correlations tile by tile, such that a tile and the temporary
+    arrays of the thresholding stay within 'memory_budget' (in bytes)
+
+    only the tiles on and below the diagonal are computed and they are given
+    directly to the thresholding, the full matrix is never created (unless the
+    engine is called directly)
+
+    the tiles are recomputed for every pass of the threshold selection, so a
+    window costs 2-3 full correlation products without a warm threshold: the
+    engine caps the memory, it is not faster than 'full'
+    """
+
+    # bytes per entry of a tile: the tile itself, the masks and the selected values during thresholding
+    BYTES_PER_ENTRY = 32
+
+    def __init__(self, *, window_length, memory_budget=256 * 2**20):
+        self.window_length = window_length
+        self.memory_budget = memory_budget
+
+    def tile_size(self, num_nodes):
+        tile_size = int(np.sqrt(self.memory_budget / self.BYTES_PER_ENTRY))
+        assert tile_size > 0, "memory budget too small"
+        return min(tile_size, num_nodes)
+
+    def chunks(self, data, first_day):
+        assert data.shape[0] == self.window_length
+        standardized = standardize(data)
+        num_nodes = standardized.shape[1]
+        return ft.partial(correlation_tiles, standardized, self.tile_size(num_nodes)), num_nodes
+
+    def __call__(self, data, first_day):
+        # assemble the full matrix (e.g. for comparisons), the tiles are absolute values, so they cannot be used
+        standardized = standardize(data)
+        return np.dot(standardized.T, standardized)
+
+
+class OutOfCoreCorrelation(TiledCorrelation):
+    """
+    compute the tiles on and below the diagonal once and store them in a
+    memory-mapped file in 'directory' (the temporary directory by default),
+    the passes of the threshold selection stream the tiles back from there
+
+    meant for grids where even a single correlation matrix does not fit into
+    memory (e.g. 40962 nodes for num_iterations == 6), only the standardized
+    data of the window and one tile are kept in memory
+
+    the tiles are stored as 'dtype', float32 halves the file size and I/O,
+    but the threshold is then found among values rounded to single precision
+    """
+
+    def __init__(self, *, window_length, memory_budget=256 * 2**20, directory=None, dtype=np.float32):
+        super().__init__(window_length=window_length, memory_budget=memory_budget)
+        self.directory = directory
+        self.dtype = dtype
+        self.storage = None
+
+    def _get_storage(self, num_tiles, tile_size):
+        shape = (num_tiles, tile_size, tile_size)
+        if self.storage is None or self.storage.shape != shape:
+            self.close()
+            file_descriptor, filename = tempfile.mkstemp(
+                prefix=".correlation-tiles-", suffix=".dat", dir=self.directory)
+            os.close(file_descriptor)
+            self.storage = np.memmap(filename, dtype=self.dtype, mode="w+", shape=shape)
+            # the mapping stays valid (POSIX), so the file is gone even if the process is killed
+            os.remove(filename)
+        return self.storage
+
+    def close(self):
+        if self.storage is not None:
+            del self.storage # the file was removed already, this frees its space
+            self.storage = None
+
+    def chunks(self, data, first_day):
+        assert data.shape[0] == self.window_length
+        standardized = standardize(data)
+        num_nodes = standardized.shape[1]
+        tile_size = self.tile_size(num_nodes)
+        num_blocks = -(-num_nodes // tile_size)
+        storage = self._get_storage(num_blocks * (num_blocks + 1) // 2, tile_size)
+
+        # a single pass computing all tiles, they are written in the same order as they are read in 'stored_tiles'
+        for k, (tile, i0, j0) in enumerate(correlation_tiles(standardized, tile_size)):
+            storage[k, : tile.shape[0], : tile.shape[1]] = tile
+            del tile
+        del standardized
+        storage.flush()
+
+        return ft.partial(stored_tiles, storage, num_nodes), num_nodes
+
+
+def stored_tiles(storage, num_nodes):
+    """read the tiles written by 'OutOfCoreCorrelation' one by one"""
+    tile_size = storage.shape[1]
+    k = 0
+    for i0 in range(0, num_nodes, tile_size):
+        num_rows = min(tile_size, num_nodes - i0)
+        for j0 in range(0, i0 + 1, tile_size):
+            num_cols = min(tile_size, num_nodes - j0)
+            yield np.array(storage[k, : num_rows, : num_cols]), i0, j0
+            k += 1
+
+
+AVAILABLE_CORRELATION_ENGINES = {
+    "full"        : FullCorrelation,
+    "incremental" : SlidingCorrelation,
+    "tiled"       : TiledCorrelation,
+    "out-of-core" : OutOfCoreCorrelation,
+}
+
+def matrix_chunks(C, *, chunk_rows=512):
+    """
+    yield row blocks of the square matrix C as (block, i0, j0),
+    where block[0, 0] == C[i0, j0]
+
+    only the entries below the diagonal (column < row) of a block are used
+    """
+    for i0 in range(0, C.shape[0], chunk_rows):
+        i1 = min(i0 + chunk_rows, C.shape[0])
+        yield C[i0 : i1, : i1], i0, 0
+
+
+def _lower_mask(shape, i0, j0):
+    # mask of the entries of a block that lie below the diagonal of the full matrix,
+    # None if the block is completely below the diagonal
+    num_rows, num_cols = shape
+    if j0 + num_cols <= i0:
+        return None
+    return (j0 + np.arange(num_cols))[np.newaxis, :] < (i0 + np.arange(num_rows))[:, np.newaxis]
+
+
+def _lower_values(block, i0, j0):
+    mask = _lower_mask(block.shape, i0, j0)
+    if mask is None:
+        return block.ravel()
+    return block[mask]
+
+
+def _lower_candidates(block, i0, j0, lower, upper=None, last_bin=False):
+    # values (and their positions) below the diagonal with lower <= value (< upper)
+    mask = block >= lower
+    if upper is not None:
+        mask &= (block <= upper) if last_bin else (block < upper)
+    lower_mask = _lower_mask(block.shape, i0, j0)
+    if lower_mask is not None:
+        mask &= lower_mask
+    del lower_mask
+    rows, cols = np.nonzero(mask)
+    return block[rows, cols], rows + i0, cols + j0
+
+
+class LinkThreshold(object):
+    """
+    find the threshold such that 'percentage' of the values lie above it
+    (same order statistic as sorting all values below the diagonal)
+
+    the selection works on a stream of chunks (see 'matrix_chunks') in linear time:
+    the first pass builds a histogram and finds the bin containing the threshold,
+    the second pass collects only the values from that bin on and uses a partition on them
+
+    with 'warm_start' the previous threshold is used as a starting point: a
+    single pass collects all values above 'previous threshold - margin' and
+    falls back to the histogram passes only if the threshold is not in there
+
+    'select' returns the edges (values above the threshold) together with the
+    threshold, they are collected during the last pass anyway
+    """
+
+    def __init__(self, percentage, *,
+                 warm_start=False,
+                 margin=0.02,
+                 num_bins=4096,
+                 value_range=(0.0, 1.0), # the absolute value of correlations
+                 max_candidates_factor=10):
+        assert 0 < percentage < 1
+        self.percentage = percentage
+        self.warm_start = warm_start
+        self.margin = margin
+        self.num_bins = num_bins
+        self.value_range = value_range
+        self.max_candidates_factor = max_candidates_factor
+        self.threshold = None # the last one found
+
+    def index(self, num_values):
+        return int((1 - self.percentage) * num_values)
+
+    def __call__(self, chunks, num_values):
+        # 'chunks' is a function returning a new iterator over the chunks for each pass
+        thr, _ = self._select(chunks, num_values, with_edges=False)
+        return thr
+
+    def select(self, chunks, num_values):
+        """return the threshold and an (num_edges, 2) array of the pairs i < j above it"""
+        thr, (values, rows, cols) = self._select(chunks, num_values, with_edges=True)
+        above = values > thr
+        # rows > cols, so exchanging them gives the upper triangle
+        edges = np.stack([cols[above], rows[above]], axis=1)
+        return thr, edges
+
+    def _select(self, chunks, num_values, with_edges):
+        k = self.index(num_values)
+        assert 0 <= k < num_values
+
+        result = None
+        if self.warm_start and self.threshold is not None:
+            result = self._select_warm(chunks, k, num_values)
+        if result is None:
+            result = self._select_cold(chunks, k, with_edges)
+        thr, candidates = result
+        self.threshold = thr
+        return thr, candidates
+
+    def _select_warm(self, chunks, k, num_values):
+        lower = self.threshold - self.margin
+        max_candidates = self.max_candidates_factor * (num_values - k)
+        num_below = 0
+        num_candidates = 0
+        candidates = []
+        for block, i0, j0 in chunks():
+            num_below += np.count_nonzero(_lower_values(block, i0, j0) < lower)
+            if num_candidates <= max_candidates:
+                candidates.append(_lower_candidates(block, i0, j0, lower))
+                num_candidates += candidates[-1][0].size
+        if num_below > k or num_candidates > max_candidates:
+            return None # the bracket was too narrow or too wide, do a full selection
+        candidates = tuple(map(np.concatenate, zip(*candidates)))
+        k_local = k - num_below
+        assert candidates[0].size == num_values - num_below
+        return candidates[0][np.argpartition(candidates[0], k_local)[k_local]], candidates
+
+    def _histogram(self, chunks, value_range):
+        hist = np.zeros((self.num_bins,), dtype=np.int64)
+        edges = None
+        num_below = num_above = 0
+        value_min, value_max = np.inf, -np.inf
+        for block, i0, j0 in chunks():
+            values = _lower_values(block, i0, j0)
+            if not values.size:
+                continue
+            value_min = min(value_min, values.min())
+            value_max = max(value_max, values.max())
+            num_below += np.count_nonzero(values < value_range[0])
+            num_above += np.count_nonzero(values > value_range[1])
+            _hist, edges = np.histogram(values, bins=self.num_bins, range=value_range)
+            hist += _hist
+            del values, _hist
+        return hist, edges, num_below, num_above, (value_min, value_max)
+
+    def _select_cold(self, chunks, k, with_edges):
+        hist, edges, num_below, num_above, observed_range = self._histogram(chunks, self.value_range)
+        if not (num_below <= k < num_below + hist.sum()):
+            # the threshold is outside of the expected range, use the observed one
+            hist, edges, num_below, num_above, _ = self._histogram(chunks, observed_range)
+            assert num_below == num_above == 0
+        cumulative = num_below + np.cumsum(hist)
+        b = np.searchsorted(cumulative, k, side="right") # index of the bin containing the k-th value
+        k_local = k - (cumulative[b] - hist[b])
+        lower, upper = edges[b], edges[b + 1]
+        last_bin = (b == self.num_bins - 1) # np.histogram includes the upper edge in the last bin
+
+        if with_edges:
+            upper = None # the values above the bin are needed for the edges
+        candidates = [_lower_candidates(block, i0, j0, lower, upper, last_bin) for block, i0, j0 in chunks()]
+        candidates = tuple(map(np.concatenate, zip(*candidates)))
+        in_bin = candidates[0]
+        if with_edges:
+            in_bin = in_bin[(in_bin <= edges[b + 1]) if last_bin else (in_bin < edges[b + 1])]
+        assert in_bin.size == hist[b]
+        return in_bin[np.argpartition(in_bin, k_local)[k_local]], candidates
+
+
+def thresholding_matrix(C, percentage, save_histo=False, *, link_threshold=None):
     '''
     In this function we will set a threshold
     in the correlation matrix in order to keep
@@ -47,22 +467,13 @@ def thresholding_matrix(C, percentage, save_histo=False):
 
     C = np.nan_to_num(C)
     C[np.diag_indices_from(C)] = 0.0
-    il = np.tril_indices(C.shape[0], k=-1)
-
-    #         flat = C[il]
-    #         hist, bins = np.histogram(flat,5000)
-    # ##         print len(hist), hist
-    # ##         print len(bins), bins
-    #         h = cumulative_distribution(1.0*hist)
-    #
-    #         v = (h>=1.0-percentage).nonzero()
-    #         thr = bins[v[0][0]]
-    flat = np.sort(C[il])
-    del il
-    assert flat.ndim == 1, "something went wrong with flattening"
-    thr_index = int((1 - percentage) * flat.shape[0])
-    thr = flat[thr_index]
-    del flat
+
+    if link_threshold is None:
+        link_threshold = LinkThreshold(percentage)
+    assert link_threshold.percentage == percentage
+
+    num_values = C.shape[0] * (C.shape[0] - 1) // 2 # number of values below the diagonal
+    thr = link_threshold(ft.partial(matrix_chunks, C), num_values)
     print("at", thr, end=" ... ")
 
     # create weighted adjacency matrix
@@ -74,4 +485,34 @@ def thresholding_matrix(C, percentage, save_histo=False):
     Cbin = (C > thr).astype(np.int8)
 
 
-    return Cbin
\ No newline at end of file
+    return Cbin
+
+
+def thresholding_edges(C, percentage, *, link_threshold=None):
+    '''
+    the same as 'thresholding_matrix', but return the links
+    as an (num_edges, 2) array of node pairs i < j instead
+    of a dense adjacency matrix
+    '''
+
+    C = np.nan_to_num(C)
+
+    # the diagonal is never used, because only values below it are considered
+    return thresholding_chunks(ft.partial(matrix_chunks, C), C.shape[0], percentage, link_threshold=link_threshold)
+
+
+def thresholding_chunks(chunks, num_nodes, percentage, *, link_threshold=None):
+    '''
+    the same as 'thresholding_edges', but for the chunks of
+    the correlation matrix as given by 'CorrelationEngine.chunks'
+    '''
+
+    if link_threshold is None:
+        link_threshold = LinkThreshold(percentage)
+    assert link_threshold.percentage == percentage
+
+    num_values = num_nodes * (num_nodes - 1) // 2
+    thr, edges = link_threshold.select(chunks, num_values)
+    print("at", thr, end=" ... ")
+
+    return edges
@@ -83,6 +83,12 @@ class DataHandler(np.ndarray):
         if isleap(date.year) and date > dt.date(date.year, 2, 29): # because Feb 29 is removed
             ind -= 1
         return ind
+
+    def getDayNumber(self, date):
+        # running day number (Feb 29 is removed), independent of the years currently loaded
+        year = date.astype(object).year
+        return year * self.num_t + self.getIndex(date) - self.loadedyears.index(year) * self.num_t
+
     def loadYear(self, year, position = "default"):
         if position == "left" or position == "default":
             position = 0
@@ -1,6 +1,8 @@
 
 
 import functools as ft
+import hashlib
+import json
 from netCDF4 import MFDataset
 import numpy as np
 import os
@@ -29,6 +31,8 @@ class NCEP_NCAR(object):
     begin_year = 1948
     end_year = 2015
 
+CLIMATOLOGY_CACHE_FILENAME_TEMPLATE = ".{base_name}.climatology.{begin_year}-{end_year}.cache.npz"
+
 class REFERENCE_TIME_RANGE(object):
     begin_year = 1950
     end_year = 2000
@@ -43,7 +47,10 @@ class DataLoader(object):
                  preprocessing_begin_year,
                  preprocessing_end_year,
                  remove_seasonality=True,
-                 surrogates=False
+                 surrogates=False,
+                 cache=True,
+                 cache_directory=None,
+                 preprocess=True
                  ):
         # TODO: there should be a dataset_type argument if one wants to make this more general
 
@@ -57,6 +64,8 @@ class DataLoader(object):
         self.preprocessing_end_year = preprocessing_end_year
         self.remove_seasonality = remove_seasonality
         self.surrogates = surrogates
+        self.cache = cache
+        self.cache_directory = data_directory if cache_directory is None else cache_directory
 
         self.preprocessing_done = False
         self.daily_mean = None # for remove_seasonality
@@ -69,7 +78,9 @@ class DataLoader(object):
         base_name = data_load_info["base-name"]
         self.file_string = NCEP_NCAR.file_strings[base_name] # in the format "prefix{year!s}postifx.extension"
 
-        self.preprocessing()
+        if preprocess:
+            self.preprocessing()
+        # else: 'set_climatology' has to be called with the results of the preprocessing of another DataLoader
 
     def _load_from_filename(self, filename):
 
@@ -135,14 +146,91 @@ class DataLoader(object):
 
         return base
 
+    def _input_filenames(self, year):
+        filename = self.file_string.format(year=year)
+        if filename.startswith("wnd"):
+            # see _load_from_filename
+            return ["u" + filename, "v" + filename]
+        return [filename]
+
+    def climatology_cache_key(self):
+        """
+        a hash of everything the preprocessing depends on, including the sizes and
+        modification times of the input files, None if an input file is missing
+        """
+        key = {
+            "base-name"   : self.data_load_info["base-name"],
+            "time-length" : self.data_load_info["time-length"],
+            "grid-shape"  : list(self.data_load_info["grid-shape"]),
+            "begin-year"  : self.preprocessing_begin_year,
+            "end-year"    : self.preprocessing_end_year,
+            "files"       : [],
+        }
+        for year in range(self.preprocessing_begin_year, self.preprocessing_end_year + 1):
+            for filename in self._input_filenames(year):
+                try:
+                    stat = os.stat(os.path.join(self.data_directory, filename))
+                except FileNotFoundError:
+                    return None
+                key["files"].append([filename, stat.st_size, stat.st_mtime_ns])
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def climatology_cache_filename(self):
+        return os.path.join(self.cache_directory, CLIMATOLOGY_CACHE_FILENAME_TEMPLATE.format(
+            base_name=self.data_load_info["base-name"],
+            begin_year=self.preprocessing_begin_year,
+            end_year=self.preprocessing_end_year,
+        ))
+
+    def _load_climatology_cache(self, cache_key):
+        cache_filename = self.climatology_cache_filename()
+        if cache_key is None or not os.path.isfile(cache_filename):
+            return False
+        with np.load(cache_filename) as cache_file:
+            if str(cache_file["key"]) != cache_key:
+                return False # the input files changed
+            daily_mean = cache_file["daily_mean"]
+            base_lon_lat = cache_file["base_lon_lat"]
+        if daily_mean.shape != (self.data_load_info["time-length"],) + self.data_load_info["grid-shape"]:
+            return False
+        self.daily_mean = daily_mean
+        self.base_lon_lat = base_lon_lat
+        return True
+
+    def _save_climatology_cache(self, cache_key):
+        cache_filename = self.climatology_cache_filename()
+        # write to a temporary file first, other (mpi) processes might be doing the same
+        tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filename, "wb") as tmp_file:
+                np.savez(tmp_file, key=cache_key, daily_mean=self.daily_mean, base_lon_lat=self.base_lon_lat)
+            os.replace(tmp_filename, cache_filename)
+        except OSError as e:
+            print("(could not write the climatology cache: {}) ".format(e), end="")
+
     def load(self, year):
         return self.load_base(year).variables[self.data_load_info["base-name"]][:]
 
+    def set_climatology(self, daily_mean, base_lon_lat):
+        # use the results of a preprocessing done somewhere else (e.g. by another mpi process)
+        assert not self.preprocessing_done, "preprocessing twice?"
+        assert daily_mean.shape == (self.data_load_info["time-length"],) + self.data_load_info["grid-shape"]
+        self.daily_mean = daily_mean
+        self.base_lon_lat = base_lon_lat
+        self.preprocessing_done = True
+
     def preprocessing(self):
         assert not self.preprocessing_done, "preprocessing twice?"
 
         base_name = self.data_load_info["base-name"]
 
+        cache_key = self.climatology_cache_key() if self.cache else None
+        if cache_key is not None and self._load_climatology_cache(cache_key):
+            print()
+            print("(%s) loaded daily means and grid from '%s'" % (base_name, self.climatology_cache_filename()))
+            self.preprocessing_done = True
+            return
+
         # create a basic data grid for a year
         self.daily_mean = np.zeros((self.data_load_info["time-length"],) + self.data_load_info["grid-shape"])
 
@@ -171,6 +259,10 @@ class DataLoader(object):
         lon_lat.shape = (2, lon_lat.shape[1] * lon_lat.shape[2])
         self.base_lon_lat = np.swapaxes(lon_lat, 0, 1)
 
+        if cache_key is not None:
+            print("... saving cache ", end="")
+            self._save_climatology_cache(cache_key)
+
         print("... done")
         self.preprocessing_done = True
 
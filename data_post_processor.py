@@ -173,21 +173,20 @@ class DataPostProcessor(mp.MapPlotter):
 
         assert date_position == "centered", "other not yet implemented"
 
-        self.correlation_time = fr.DEFAULT_RUN_INFO["correlation-time"]  # TODO: read from hdf5-file
-
         with h5py.File(input_file_name, "r") as in_file:
+            # older files have no run info in the header
+            self.correlation_time = int(in_file["header"].attrs.get("correlation-time", fr.DEFAULT_RUN_INFO["correlation-time"]))
+
             end_dates = np.array(in_file["data/dates"][:, 1], dtype=ga.NUMPY_DATE_TYPE)
             mid_dates = end_dates - np.timedelta64(self.correlation_time // 2, "D")
             del end_dates
 
-            arrays_dict = dict(in_file["data/arrays"])
+            arrays_dict, self.field_dict = ga.read_results(in_file)
             arrays_dict["date"] = mid_dates
             self.timeseries = pd.DataFrame.from_dict(arrays_dict)
             self.timeseries.set_index("date", inplace=True)
             del arrays_dict
 
-            self.field_dict = {key: np.array(in_file["data/fields"][key]) for key in in_file["data/fields"]}
-
         for field_name, field_data in self.field_dict.items():
             assert field_data.shape == (len(self.timeseries), ) + self.grid_obj.grid.shape[:1], \
                 f"data shape of {field_name!r} doesn't match grid and dates input"
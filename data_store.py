@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+
+from dates import isleap
+
+import datetime as dt
+import functools as ft
+import json
+import numpy as np
+import os
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+DATA_STORE_FILENAME_TEMPLATE = "{base_name}.{grid}.store.npy"
+DATA_STORE_INFO_SUFFIX = ".json"
+
+
+class DataStore(object):
+    """
+    the remapped (and deseasonalized) data of all years as one (days, nodes) array,
+    usually memory-mapped from the file written by 'build_data_store'
+
+    provides the part of the 'DataHandler' interface used by fullrun.py,
+    but windows are simply views into the array, nothing has to be loaded
+    """
+
+    def __init__(self, data, *, begin_year, num_t, info=""):
+        assert data.ndim == 2
+        assert data.shape[0] % num_t == 0
+
+        self.data = data
+        self.begin_year = begin_year
+        self.num_t = num_t
+        self.end_year = begin_year + data.shape[0] // num_t - 1
+        self.grid_shape = data.shape[1:]
+        self.info = info
+        self.loadedyears = [0, 0]
+
+    def loadYears(self, y1, y2):
+        # nothing to load, only check that the data is there
+        assert self.begin_year <= y1 <= y2 <= self.end_year, f"years {y1} - {y2} not in the data store ({self.begin_year} - {self.end_year})"
+        self.loadedyears = [y1, y2]
+
+    def getIndex(self, date):
+        # relative to the first day in the data store
+        date = date.astype(object)
+        ind = (date.year - self.begin_year) * self.num_t + date.timetuple().tm_yday - 1
+        if isleap(date.year) and date > dt.date(date.year, 2, 29): # because Feb 29 is removed
+            ind -= 1
+        return ind
+
+    def getDayNumber(self, date):
+        return self.begin_year * self.num_t + self.getIndex(date)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+
+def data_store_info_filename(filename):
+    return filename + DATA_STORE_INFO_SUFFIX
+
+
+def remap_years(out, *, data_loader, grid_obj, begin_year, end_year):
+    # remap the (deseasonalized) years one after another into 'out'
+    num_t = data_loader.data_load_info["time-length"]
+    for i, year in enumerate(range(begin_year, end_year + 1)):
+        print(f"({year}) ", end="")
+        out[i * num_t : (i + 1) * num_t] = grid_obj.remap(data_loader.load(year))
+        print(" ... ", end="")
+
+
+def shared_data_store(*, data_loader, grid_obj, begin_year, end_year, info="", dtype=np.float64):
+    """
+    remap the years into a new block of shared memory, returns the data store and the
+    'multiprocessing.shared_memory.SharedMemory', which has to be unlinked by the caller
+
+    float64 by default, like the 'DataHandler', so the results are the same
+    """
+    from multiprocessing import shared_memory
+
+    assert data_loader.preprocessing_done
+    num_t = data_loader.data_load_info["time-length"]
+    shape = ((end_year - begin_year + 1) * num_t, grid_obj.grid.shape[0])
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    remap_years(data, data_loader=data_loader, grid_obj=grid_obj, begin_year=begin_year, end_year=end_year)
+    return DataStore(data, begin_year=begin_year, num_t=num_t, info=info), shm
+
+
+def mpi_shared_data_store(comm, *, data_loader, grid_obj, begin_year, end_year, num_t, info="", dtype=np.float64):
+    """
+    like 'shared_data_store' for the mpi processes on one node: the first process of
+    each node remaps the years into an mpi shared memory window, the others map it
+
+    returns the data store and the window, which has to be freed collectively by the processes of the node
+    """
+    from mpi4py import MPI
+
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    is_node_leader = node_comm.rank == 0
+    dtype = np.dtype(dtype)
+    shape = ((end_year - begin_year + 1) * num_t, grid_obj.grid.shape[0])
+    size = int(np.prod(shape)) * dtype.itemsize if is_node_leader else 0
+    window = MPI.Win.Allocate_shared(size, dtype.itemsize, comm=node_comm)
+    buffer, itemsize = window.Shared_query(0)
+    assert itemsize == dtype.itemsize
+    data = np.ndarray(shape, dtype=dtype, buffer=buffer)
+    if is_node_leader:
+        assert data_loader is not None and data_loader.preprocessing_done
+        remap_years(data, data_loader=data_loader, grid_obj=grid_obj, begin_year=begin_year, end_year=end_year)
+    node_comm.Barrier() # wait until the data is there
+    data.flags.writeable = False
+    return DataStore(data, begin_year=begin_year, num_t=num_t, info=info), window
+
+
+def build_data_store(filename, *,
+                     data_loader,
+                     grid_obj,
+                     begin_year,
+                     end_year,
+                     info=None,
+                     dtype=np.float32):
+    """remap all years once and write them into a single contiguous array in 'filename' (.npy format)"""
+
+    assert data_loader.preprocessing_done
+    num_t = data_loader.data_load_info["time-length"]
+    num_years = end_year - begin_year + 1
+    shape = (num_years * num_t, grid_obj.grid.shape[0])
+
+    # write to a temporary file first, so an interrupted ingest doesn't leave a valid looking store
+    tmp_filename = filename + ".tmp"
+    store = np.lib.format.open_memmap(tmp_filename, mode="w+", dtype=dtype, shape=shape)
+    remap_years(store, data_loader=data_loader, grid_obj=grid_obj, begin_year=begin_year, end_year=end_year)
+    store.flush()
+    del store
+    os.replace(tmp_filename, filename)
+
+    store_info = {
+        "base-name"          : data_loader.data_load_info["base-name"],
+        "begin-year"         : begin_year,
+        "end-year"           : end_year,
+        "time-length"        : num_t,
+        "num-nodes"          : shape[1],
+        "dtype"              : np.dtype(dtype).str,
+        "remove-seasonality" : data_loader.remove_seasonality,
+        "preprocessing-begin-year" : data_loader.preprocessing_begin_year,
+        "preprocessing-end-year"   : data_loader.preprocessing_end_year,
+    }
+    if info is not None:
+        store_info.update(info)
+    with open(data_store_info_filename(filename), "w") as info_file:
+        json.dump(store_info, info_file, indent=4, sort_keys=True)
+
+    return store_info
+
+
+def load_data_store_info(filename):
+    with open(data_store_info_filename(filename), "r") as info_file:
+        return json.load(info_file)
+
+
+def open_data_store(filename):
+    store_info = load_data_store_info(filename)
+    data = np.load(filename, mmap_mode="r")
+    assert data.shape == ((store_info["end-year"] - store_info["begin-year"] + 1) * store_info["time-length"], store_info["num-nodes"]), \
+        f"'{filename}' doesn't match its info file"
+    return DataStore(
+        data,
+        begin_year=store_info["begin-year"],
+        num_t=store_info["time-length"],
+        info=store_info["base-name"] + "-s"
+    ), store_info
+
+
+if __name__ == "__main__":
+    # create the data store, run this once per grid and variable (without mpi)
+    import fullrun as fr
+    from data_loader import DataLoader, NCEP_NCAR
+
+    import argcomplete, argparse
+
+    parser = argparse.ArgumentParser(description="remap and deseasonalize all years once and save them in a single memory-mappable file")
+    parser.add_argument("--grid", default=fr.RunGrids.icosahedral.name, choices=fr.grid_choices,
+                        help="set which grid should be used")
+    parser.add_argument("--variable", default="air", choices=sorted(NCEP_NCAR.variables),
+                        help="the variable of the data, default: 'air'")
+    parser.add_argument("--data-directory", metavar="directory", default="data/",
+                        help="the directory where the SAT data can be found, default './data'")
+    parser.add_argument("-o", "--output", type=str, metavar="file",
+                        help="output file, default: '<data-directory>/" + DATA_STORE_FILENAME_TEMPLATE + "'")
+
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = os.path.join(args.data_directory, DATA_STORE_FILENAME_TEMPLATE.format(base_name=args.variable, grid=args.grid))
+    if os.path.exists(args.output):
+        parser.error("'{}' exists already".format(args.output))
+
+    data_info = {
+        "base-name"  : args.variable,
+        "time-length": NCEP_NCAR.time_length,
+        "grid-shape" : NCEP_NCAR.grid_shape,
+    }
+
+    dl = DataLoader(
+        args.data_directory,
+        data_load_info = data_info,
+        preprocessing_begin_year=NCEP_NCAR.begin_year,
+        preprocessing_end_year=NCEP_NCAR.end_year,
+        remove_seasonality=True,
+        surrogates=False
+    )
+
+    print("generating icosahedral grid ... ", end="")
+    grid_obj = fr.RunGrids[args.grid].value(
+        base_grid=dl.base_lon_lat,
+        num_t=data_info["time-length"],
+        inline_verb=True,
+    )
+    print("done")
+
+    print(f"writing data store '{args.output}' ... ", end="")
+    build_data_store(
+        args.output,
+        data_loader=dl,
+        grid_obj=grid_obj,
+        begin_year=NCEP_NCAR.begin_year,
+        end_year=NCEP_NCAR.end_year,
+        info={"grid" : args.grid}
+    )
+    print("done")
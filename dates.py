@@ -11,14 +11,15 @@ import argparse
 default_begin_date = dt.date(NCEP_NCAR.begin_year, 1, 1)
 default_end_date = dt.date(NCEP_NCAR.end_year, 12, 31)
 
-def parse_date(s):
+def parse_date(s, *, last_date=default_end_date):
+    # last_date can be later, when more years of data are available
     try:
         date = dt.datetime.strptime(s, "%Y-%m-%d").date()
-        if not (default_begin_date <= date <= default_end_date):
+        if not (default_begin_date <= date <= last_date):
             raise ValueError
         return date
     except ValueError:
-        msg = "Not a valid date '{0}', should be 'yyyy-mm-dd' and between {} and {}".format(s, default_begin_date, default_end_date)
+        msg = "Not a valid date '{0}', should be 'yyyy-mm-dd' and between {} and {}".format(s, default_begin_date, last_date)
         # TODO: check why the message is not shown correctly
         raise argparse.ArgumentTypeError(msg)
 
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+
+import benchmarks as bm
+from correlation import AVAILABLE_CORRELATION_ENGINES, LinkThreshold, corr_coeff, thresholding_chunks
+from data_loader import NCEP_NCAR
+import fullrun as fr
+import graph_analysis as ga
+import synthetic_data as sd
+
+import contextlib
+import functools as ft
+import io
+import json
+import numpy as np
+import os
+import random
+import tempfile
+import time
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+# the optimized results are equivalent to the reference if they differ by less than these
+DEFAULT_THRESHOLD_ATOL = 1e-6 # the out-of-core engine stores the correlations in single precision
+DEFAULT_EDGE_TOLERANCE = 0. # fraction of the reference edges that may be missing or extra
+DEFAULT_RTOL = 1e-7
+DEFAULT_ATOL = 1e-12
+
+
+def reference_threshold(correlations, percentage):
+    # the order statistic by sorting all values below the diagonal, like the original 'thresholding_matrix'
+    values = np.sort(correlations[np.tril_indices(correlations.shape[0], k=-1)])
+    return values[int((1 - percentage) * values.shape[0])]
+
+
+def reference_window(window, grid_obj, *, percentage):
+    """
+    the original path: the full correlation matrix, the threshold by sorting, a dense adjacency
+    matrix and the link lengths summed up edge by edge, returns the threshold, the edges and the results
+    """
+    correlations = np.nan_to_num(np.abs(corr_coeff(window)))
+    threshold = reference_threshold(correlations, percentage)
+    # not 'thresholding_matrix', it selects the threshold like the engines do
+    adjacency = (correlations > threshold).astype(np.int8)
+    adjacency[np.diag_indices_from(adjacency)] = 0
+    del correlations
+    edges = np.argwhere(np.triu(adjacency, k=1))
+    graph = bm.adjacency_graph(adjacency, grid_obj)
+    del adjacency
+    return threshold, edges, ga.get_results(graph, reference=True)
+
+
+def optimized_window(window, first_day, grid_obj, *, percentage, engine, link_threshold):
+    """the path of fullrun.py with the given correlation engine and link threshold"""
+    chunks, num_nodes = engine.chunks(window, first_day)
+    edges = thresholding_chunks(chunks, num_nodes, percentage, link_threshold=link_threshold)
+    del chunks
+    graph = bm.window_graph(edges, grid_obj)
+    return link_threshold.threshold, edges, ga.get_results(graph, unit_vectors=ga.link_unit_vectors(grid_obj))
+
+
+def edge_differences(reference_edges, edges, num_nodes):
+    """the number of edges only in the reference and only in 'edges'"""
+    def keys(edges):
+        edges = np.sort(np.asarray(edges, dtype=np.int64).reshape((-1, 2)), axis=1)
+        return edges[:, 0] * num_nodes + edges[:, 1]
+    reference_keys, other_keys = keys(reference_edges), keys(edges)
+    return np.setdiff1d(reference_keys, other_keys).size, np.setdiff1d(other_keys, reference_keys).size
+
+
+def result_differences(reference_results, results, *, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL):
+    """the largest absolute and relative differences of the results (the fields element by element) and whether they are within the tolerances"""
+    differences = {}
+    for reference_values, values in zip(reference_results, results): # the single values and the fields
+        for key, reference_value in reference_values.items():
+            reference_value = np.atleast_1d(np.asarray(reference_value, dtype=np.float64))
+            value = np.atleast_1d(np.asarray(values[key], dtype=np.float64))
+            assert value.shape == reference_value.shape, f"{key}: shape {value.shape} instead of {reference_value.shape}"
+            with np.errstate(invalid="ignore", divide="ignore"):
+                absolute = np.abs(value - reference_value)
+                absolute[np.isnan(value) != np.isnan(reference_value)] = np.inf
+                absolute[np.isnan(value) & np.isnan(reference_value)] = 0.
+                relative = np.where(absolute > 0, absolute / np.abs(reference_value), 0.)
+            differences[key] = {
+                "max-abs"    : float(absolute.max(initial=0.)),
+                "max-rel"    : float(relative.max(initial=0.)),
+                "equivalent" : bool(np.allclose(value, reference_value, rtol=rtol, atol=atol, equal_nan=True)),
+            }
+    return differences
+
+
+def compare_windows(data, grid_obj, *,
+                    window_length,
+                    time_step,
+                    num_windows,
+                    percentage,
+                    engine,
+                    warm_start=True,
+                    threshold_atol=DEFAULT_THRESHOLD_ATOL,
+                    edge_tolerance=DEFAULT_EDGE_TOLERANCE,
+                    rtol=DEFAULT_RTOL,
+                    atol=DEFAULT_ATOL):
+    """
+    compute consecutive windows of 'data' with the reference and the optimized path
+    (in order, so the incremental engine and the warm start of the threshold are used)
+    and return a record of the differences and the times of each window
+    """
+    num_nodes = grid_obj.grid.shape[0]
+    link_threshold = LinkThreshold(percentage, warm_start=warm_start)
+    records = []
+    for index in range(num_windows):
+        first_day = index * time_step
+        window = data[first_day : first_day + window_length]
+        assert window.shape[0] == window_length, "not enough data for the windows"
+
+        with contextlib.redirect_stdout(io.StringIO()): # the progress output of the stages
+            # igraph uses 'random', some community detections (e.g. label propagation) are random
+            random.seed(index)
+            t0 = time.perf_counter()
+            reference_threshold_value, reference_edges, reference_results = reference_window(window, grid_obj, percentage=percentage)
+            reference_time = time.perf_counter() - t0
+            random.seed(index) # the same as for the reference
+            t0 = time.perf_counter()
+            threshold, edges, results = optimized_window(window, first_day, grid_obj, percentage=percentage, engine=engine, link_threshold=link_threshold)
+            optimized_time = time.perf_counter() - t0
+
+        missing_edges, extra_edges = edge_differences(reference_edges, edges, num_nodes)
+        differences = result_differences(reference_results, results, rtol=rtol, atol=atol)
+        threshold_difference = float(threshold - reference_threshold_value)
+        record = {
+            "index"                : index,
+            "first-day"            : first_day,
+            "threshold"            : float(reference_threshold_value),
+            "threshold-difference" : threshold_difference,
+            "num-edges"            : len(reference_edges),
+            "missing-edges"        : missing_edges,
+            "extra-edges"          : extra_edges,
+            "results"              : differences,
+            "reference-time"       : reference_time,
+            "optimized-time"       : optimized_time,
+            "speed-up"             : reference_time / optimized_time,
+        }
+        record["equivalent"] = bool(
+            abs(threshold_difference) <= threshold_atol
+            and missing_edges + extra_edges <= edge_tolerance * len(reference_edges)
+            and all(difference["equivalent"] for difference in differences.values())
+        )
+        records.append(record)
+        print_window(record)
+    engine.close()
+    return records
+
+
+def print_window(record):
+    worst_key, worst = max(record["results"].items(), key=lambda item: item[1]["max-rel"], default=("-", {"max-rel": 0.}))
+    print(f"{record['index']:5d} (day {record['first-day']:4d}): threshold {record['threshold']:0.6f} ({record['threshold-difference']:+0.1e}), "
+          f"edges -{record['missing-edges']}/+{record['extra-edges']} of {record['num-edges']}, "
+          f"max rel. difference {worst['max-rel']:0.1e} ({worst_key}), "
+          f"{record['reference-time']:0.2f} s -> {record['optimized-time']:0.2f} s ({record['speed-up']:0.1f}x) ... "
+          + ("equivalent" if record["equivalent"] else "DIVERGED"))
+
+
+def summarize(records):
+    """the total speed-up and the largest differences over all windows"""
+    reference_time = sum(record["reference-time"] for record in records)
+    optimized_time = sum(record["optimized-time"] for record in records)
+    return {
+        "num-windows"              : len(records),
+        "num-diverged"             : sum(not record["equivalent"] for record in records),
+        "reference-time"           : reference_time,
+        "optimized-time"           : optimized_time,
+        "speed-up"                 : reference_time / optimized_time,
+        "max-threshold-difference" : max(abs(record["threshold-difference"]) for record in records),
+        "max-edge-differences"     : max(record["missing-edges"] + record["extra-edges"] for record in records),
+        "results" : {
+            key: {
+                "max-abs" : max(record["results"][key]["max-abs"] for record in records),
+                "max-rel" : max(record["results"][key]["max-rel"] for record in records),
+            }
+            for key in records[0]["results"]
+        },
+    }
+
+
+if __name__ == "__main__":
+    # check that an optimized configuration gives the results of the reference path
+    import argcomplete, argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="compute windows with the reference path (full correlation matrix, sorted threshold, "
+                                     "adjacency matrix, edge by edge link lengths) and an optimized configuration, "
+                                     "compare the thresholds, edges and results and report the speed-up")
+    parser.add_argument("-o", "--output", metavar="file",
+                        help="write the comparison of every window and the summary to this file (json)")
+
+    parser.add_argument("--correlation-engine", choices=sorted(AVAILABLE_CORRELATION_ENGINES), default="incremental",
+                        help="the correlation engine of the optimized configuration, default: incremental")
+    parser.add_argument("--memory-budget", type=int, default=fr.DEFAULT_RUN_INFO["memory-budget"], metavar="MB",
+                        help="for the 'tiled' and 'out-of-core' correlation engines, default: {} MB".format(fr.DEFAULT_RUN_INFO["memory-budget"]))
+    parser.add_argument("--cold-threshold", action="store_false", dest="warm_start",
+                        help="don't start the threshold search at the previous threshold")
+    parser.add_argument("--metrics", nargs="+", choices=bm.FIELD_METRICS + bm.ARRAY_METRICS, metavar="metric",
+                        help="the results compared, default: the ones of the paper ({})".format(", ".join(ga.RESULT_ARRAYS + ga.RESULT_FIELDS)))
+
+    parser.add_argument("--num-iterations", type=int, default=4, metavar="N",
+                        help="the refinement of the icosahedral grid (5 is the grid of the paper), default: 4")
+    parser.add_argument("--window-length", type=int, default=fr.DEFAULT_RUN_INFO["correlation-time"], metavar="days",
+                        help="default: {}".format(fr.DEFAULT_RUN_INFO["correlation-time"]))
+    parser.add_argument("--time-step", type=int, default=1, metavar="days",
+                        help="between consecutive windows, default: 1")
+    parser.add_argument("--num-windows", type=int, default=10, metavar="N",
+                        help="default: 10")
+    parser.add_argument("--cut-off-percentage", type=float, default=fr.DEFAULT_RUN_INFO["cut-off-percentage"], metavar="fraction",
+                        help="default: {}".format(fr.DEFAULT_RUN_INFO["cut-off-percentage"]))
+
+    parser.add_argument("--threshold-atol", type=float, default=DEFAULT_THRESHOLD_ATOL, metavar="value",
+                        help="largest allowed difference of the thresholds, default: {}".format(DEFAULT_THRESHOLD_ATOL))
+    parser.add_argument("--edge-tolerance", type=float, default=DEFAULT_EDGE_TOLERANCE, metavar="fraction",
+                        help="fraction of the edges that may be missing or extra, default: {}".format(DEFAULT_EDGE_TOLERANCE))
+    parser.add_argument("--rtol", type=float, default=DEFAULT_RTOL, metavar="value",
+                        help="relative tolerance of the results, default: {}".format(DEFAULT_RTOL))
+    parser.add_argument("--atol", type=float, default=DEFAULT_ATOL, metavar="value",
+                        help="absolute tolerance of the results, default: {}".format(DEFAULT_ATOL))
+
+    parser.add_argument("--data-directory", metavar="directory",
+                        help="the SAT data, default: synthetic data (see synthetic_data.py) in a temporary directory")
+    parser.add_argument("--begin-year", type=int, default=bm.BENCHMARK_YEARS[0], metavar="year",
+                        help="the first window starts on Jan 1 of this year, default: {}".format(bm.BENCHMARK_YEARS[0]))
+    parser.add_argument("--scratch-directory", metavar="directory",
+                        help="a directory, where the temporary data should be saved")
+
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    if args.num_windows < 1 or args.time_step < 1 or args.window_length < 2:
+        parser.error("the number of windows and the time step have to be positive and the windows at least two days long")
+    if args.output is not None and os.path.exists(args.output):
+        parser.error("'{}' exists already".format(args.output))
+
+    num_days = (args.num_windows - 1) * args.time_step + args.window_length
+    years = list(range(args.begin_year, args.begin_year + -(-num_days // NCEP_NCAR.time_length)))
+
+    metrics = ga.RESULT_ARRAYS + ga.RESULT_FIELDS if args.metrics is None else args.metrics
+
+    engine_options = {}
+    if args.correlation_engine in ["tiled", "out-of-core"]:
+        engine_options["memory_budget"] = args.memory_budget * 2**20
+    if args.correlation_engine == "out-of-core":
+        engine_options["directory"] = args.scratch_directory
+    engine = AVAILABLE_CORRELATION_ENGINES[args.correlation_engine](window_length=args.window_length, **engine_options)
+
+    with contextlib.ExitStack() as stack:
+        data_directory = args.data_directory
+        if data_directory is None:
+            data_directory = stack.enter_context(tempfile.TemporaryDirectory(prefix=".equivalence-data-", dir=args.scratch_directory))
+            print("writing synthetic data ... ", end="")
+            sd.generate(data_directory, begin_year=years[0], end_year=years[-1], verbose=0)
+            print("done")
+
+        print(f"loading and remapping {years[0]} - {years[-1]} ... ", end="")
+        data_loader = bm.open_data(data_directory, years=years)
+        grid_obj = bm.open_grid(args.num_iterations, data_loader)
+        data = bm.remapped_years(data_loader, grid_obj, years=years)
+        del data_loader
+        print("done")
+
+    print(f"comparing {args.num_windows} windows on {grid_obj.grid.shape[0]} nodes: reference against "
+          f"the '{args.correlation_engine}' engine with a {'warm' if args.warm_start else 'cold'} threshold search")
+    with bm.result_keys(arrays=[key for key in metrics if key in bm.ARRAY_METRICS], fields=[key for key in metrics if key in bm.FIELD_METRICS]):
+        records = compare_windows(
+            data, grid_obj,
+            window_length=args.window_length,
+            time_step=args.time_step,
+            num_windows=args.num_windows,
+            percentage=args.cut_off_percentage,
+            engine=engine,
+            warm_start=args.warm_start,
+            threshold_atol=args.threshold_atol,
+            edge_tolerance=args.edge_tolerance,
+            rtol=args.rtol,
+            atol=args.atol
+        )
+
+    summary = summarize(records)
+    print()
+    print(f"speed-up: {summary['speed-up']:0.2f}x ({summary['reference-time']:0.2f} s -> {summary['optimized-time']:0.2f} s)")
+    print(f"threshold: max difference {summary['max-threshold-difference']:0.1e}")
+    print(f"edges: max {summary['max-edge-differences']} different")
+    for key, difference in summary["results"].items():
+        print(f"{key}: max abs. difference {difference['max-abs']:0.1e}, max rel. difference {difference['max-rel']:0.1e}")
+
+    if args.output is not None:
+        print(f"writing '{args.output}' ... ", end="")
+        with open(args.output, "w") as out_file:
+            json.dump({"info" : bm.benchmark_info({
+                "correlation-engine" : args.correlation_engine,
+                "warm-start"         : args.warm_start,
+                "nodes"              : grid_obj.grid.shape[0],
+                "window-length"      : args.window_length,
+                "time-step"          : args.time_step,
+                "cut-off-percentage" : args.cut_off_percentage,
+                "data"               : "synthetic" if args.data_directory is None else os.path.abspath(args.data_directory),
+                "tolerances"         : {"threshold-atol" : args.threshold_atol, "edge-tolerance" : args.edge_tolerance, "rtol" : args.rtol, "atol" : args.atol},
+            }), "summary" : summary, "windows" : records}, out_file, indent=4)
+        print("done")
+
+    if summary["num-diverged"]:
+        sys.exit(f"{summary['num-diverged']}/{summary['num-windows']} windows diverged from the reference")
+    print(f"all {summary['num-windows']} windows are equivalent")
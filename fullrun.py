@@ -2,20 +2,30 @@
 # PYTHON_ARGCOMPLETE_OK
 
 import graph_analysis as ga
-from correlation import corr_coeff, thresholding_matrix
+from correlation import AVAILABLE_CORRELATION_ENGINES, LinkThreshold, thresholding_chunks
 from data_handler import DataHandler
 from data_loader import DataLoader, NCEP_NCAR
+from data_store import mpi_shared_data_store, open_data_store, shared_data_store
 from dates import default_begin_date, default_end_date, parse_date, get_date_pairs_list
 import icosahedral_grid as ico
+import instrumentation as instr
+from pipeline import run_pipeline
+import window_scheduler as ws
 
 from simple_mpi import mpi
 
 import argcomplete, argparse
 import atexit
+import concurrent.futures
+import cProfile
 import datetime as dt
 from enum import Enum
 import functools as ft
+import glob
+import h5py
 import igraph as ig
+import multiprocessing
+import multiprocessing.util
 import numpy as np
 import operator
 import time
@@ -35,8 +45,19 @@ DEFAULT_RUN_INFO = {
     "cut-off-percentage" : 0.005,
     "time-step"          : 15,
     "grid-type"          : "icosahedral",
+    "correlation-engine" : "full",
+    "memory-budget"      : 256, # MB, for the tiled correlation engine
+    "output-layout"      : "gzip", # see graph_analysis.OUTPUT_LAYOUTS
+    "output-chunk-shape" : ga.DEFAULT_FIELD_CHUNK_SHAPE,
+    "compact-output"     : True, # integer degrees, see graph_analysis.COUNT_RESULT_FIELDS
 }
 
+# have to be the same when continuing a run
+CONTINUE_RUN_INFO_KEYS = ["correlation-time", "cut-off-percentage", "time-step", "grid", "preprocessing-begin-year", "preprocessing-end-year"]
+
+# how the daily means for removing the seasonality are chosen when data of new years is used
+CLIMATOLOGY_POLICIES = ["fixed", "recompute"]
+
 RUN_INFOS = {
     "normal"  : {},
     "fast"    : {
@@ -48,65 +69,174 @@ RUN_INFOS = {
     "daily"    : {
         "time-step" : 1,
     },
+    "daily-incremental" : {
+        "time-step" : 1,
+        "correlation-engine" : "incremental", # update the correlation matrix with the day leaving and the day entering the window
+    },
 }
 
-def analyze(index, begin_date, end_date,
-            *,
-            run_info,
-            out_file_name):
+def compute_edges(index, begin_date, end_date,
+                  *,
+                  run_info):
     # using global variables, because it should actually be part of the script, but like this there might be the possibility to use mpi later
 
     print()
     print("(%s| %5i) starting with %s -> %s " % (base_name, index, begin_date, end_date))
     print()
 
-    dh.loadYears(begin_date.astype(object).year, end_date.astype(object).year)
+    timing = instr.WindowTiming(index, rank=mpi.rank if mpi.available else 0)
+
+    with timing.stage("load"):
+        dh.loadYears(begin_date.astype(object).year, end_date.astype(object).year)
 
     daynum0 = dh.getIndex(begin_date)
     daynum1 = dh.getIndex(end_date)
     assert daynum1 - daynum0 == run_info["correlation-time"], "%i %i" % (daynum1, daynum0)
 
-    print("calculating correlation matrix ...", end=" ")
+    # running day number, so the correlation engine can recognize overlapping windows
+    first_day = dh.getDayNumber(begin_date)
+
+    print("calculating correlations ...", end=" ")
     t0 = time.time()
-    correlation_matrix = np.nan_to_num(np.abs(corr_coeff(dh[daynum0 : daynum1])))
+    # engines computing the correlations tile by tile do it lazily during the thresholding
+    with timing.stage("correlation"):
+        correlation_chunks, num_nodes = corr_engine.chunks(dh[daynum0 : daynum1], first_day)
     print("done (total %0.2f s)" % (time.time() - t0))
 
-    print('thresholding_matrix ...', end=" ")
+    print('thresholding ...', end=" ")
     t0 = time.time()
-    Adjacency = thresholding_matrix(correlation_matrix, run_info["cut-off-percentage"])
+    with timing.stage("threshold"):
+        edges = thresholding_chunks(correlation_chunks, num_nodes, run_info["cut-off-percentage"], link_threshold=link_threshold)
     print("done (total %0.2f s)" % (time.time() - t0))
-    del correlation_matrix
+    del correlation_chunks
+
+    return edges, num_nodes, timing
 
-    print("create graph from adjacency matrix ... ", end="")
+def compute_metrics(index, edges, num_nodes, timing):
+    print("(%s| %5i) create graph from edge list ... " % (base_name, index), end="")
     t0 = time.time()
-    graph = ig.Graph().Adjacency(Adjacency.tolist(), mode=ig.ADJ_UNDIRECTED)
-    del Adjacency
-    ################################################################################################################################################
-    assert len(graph.vs) == grid_obj.grid.shape[0]
-    graph.vs["lon_lat"] = grid_obj.grid
-    assert np.allclose(graph.vs[len(graph.vs) - 1]["lon_lat"], grid_obj.grid[-1])
-    ################################################################################################################################################
+    with timing.stage("graph"):
+        graph = ig.Graph(n=num_nodes, edges=edges.tolist())
+        del edges
+        ################################################################################################################################################
+        assert len(graph.vs) == grid_obj.grid.shape[0]
+        graph.vs["lon_lat"] = grid_obj.grid
+        assert np.allclose(graph.vs[len(graph.vs) - 1]["lon_lat"], grid_obj.grid[-1])
+        ################################################################################################################################################
     print("done (total %0.2f s)" % (time.time() - t0))
     num_v, num_e = graph.vcount(), graph.ecount()
     num_e_max = num_v * (num_v - 1) / 2
     print("%i nodes, %i edges (%0.10f%% of max %i)" % (num_v, num_e, float(num_e) / num_e_max, num_e_max))
 
     # get results
-    result_singles, result_fields = ga.get_results(graph)
+    with timing.stage("metrics"):
+        result_singles, result_fields = ga.get_results(graph, unit_vectors=ga.link_unit_vectors(grid_obj))
     for key in result_singles:
         print(key, ":", result_singles[key])
     for key, field in result_fields.items():
         field = result_fields[key]
         print(key, ": (avg)", np.average(field))
 
-    # write results to the hdf5file
-    ga.save_results(
+    return result_singles, result_fields, timing.record()
+
+def compute_results(index, begin_date, end_date,
+                    *,
+                    run_info):
+    edges, num_nodes, timing = compute_edges(index, begin_date, end_date, run_info=run_info)
+    return compute_metrics(index, edges, num_nodes, timing)
+
+METRIC_EXECUTORS = {
+    # forked, so the workers inherit the grid
+    "process" : ft.partial(concurrent.futures.ProcessPoolExecutor, mp_context=multiprocessing.get_context("fork")),
+    # igraph keeps the GIL, but the correlations (BLAS) don't, e.g. for mpi processes, which should not fork
+    "thread"  : concurrent.futures.ThreadPoolExecutor,
+}
+
+def run_pipelined(work, *, run_info, writer_factory, metric_executor, metric_workers, depth):
+    """
+    the correlations and thresholds of the windows are computed in this thread (in order,
+    the engines keep state), while the graph measures of the windows before are computed by
+    'metric_workers' processes or threads and the results are written by the writer's thread
+    """
+    executor_options = {}
+    if metric_executor == "process":
+        # every worker waits in its initializer until all are started, so all of them are forked before
+        # the writer starts its thread (holding the hdf5 locks), also if they are started on demand (python < 3.11)
+        executor_options["initializer"] = multiprocessing.get_context("fork").Barrier(metric_workers).wait
+    with METRIC_EXECUTORS[metric_executor](max_workers=metric_workers, **executor_options) as executor:
+        for future in [executor.submit(int) for _ in range(metric_workers)]:
+            future.result()
+        with writer_factory() as writer:
+            def write(item, results):
+                index, (begin_date, end_date) = item
+                result_singles, result_fields, timing = results
+                writer.write(
+                    index, begin_date, end_date,
+                    single_vals=result_singles,
+                    fields=result_fields,
+                    timing=timing
+                )
+
+            run_pipeline(
+                work,
+                first_stage=lambda item: (item[0],) + compute_edges(item[0], *item[1], run_info=run_info),
+                second_stage=compute_metrics,
+                handle_result=write,
+                executor=executor,
+                depth=depth
+            )
+
+def analyze(index, begin_date, end_date,
+            *,
+            run_info,
+            writer):
+    result_singles, result_fields, timing = compute_results(
+        index, begin_date, end_date,
+        run_info=run_info
+    )
+
+    # write results to the hdf5file (buffered)
+    writer.write(
         index, begin_date, end_date,
-        out_file_name=out_file_name,
         single_vals=result_singles,
-        fields=result_fields
+        fields=result_fields,
+        timing=timing
     )
 
+def init_worker():
+    # the engine keeps its state (the running sums, the tile file) from one chunk to the next,
+    # it is closed when the worker process exits (atexit handlers are not run there)
+    multiprocessing.util.Finalize(None, corr_engine.close, exitpriority=0)
+
+def compute_chunk(chunk, *, run_info):
+    # run in the worker processes of --workers, the results are written by the main process
+    return [
+        (index, begin_date, end_date) + compute_results(index, begin_date, end_date, run_info=run_info)
+        for index, (begin_date, end_date) in chunk
+    ]
+
+def run_workers(work, *, num_workers, run_info, writer_factory, min_chunk_size):
+    """
+    compute the windows in 'work' with a pool of forked worker processes, they get
+    chunks of consecutive windows like with the dynamic mpi schedule (see window_scheduler.py)
+    """
+    mp_context = multiprocessing.get_context("fork") # the workers inherit the data, grid and engines
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context, initializer=init_worker) as executor:
+        futures = [
+            executor.submit(compute_chunk, work[begin:end], run_info=run_info)
+            for begin, end in ws.guided_chunks(len(work), num_workers, min_chunk_size=min_chunk_size)
+        ]
+        # the workers are forked at the first submit, only then the writer starts its thread
+        with writer_factory() as writer:
+            for future in concurrent.futures.as_completed(futures):
+                for index, begin_date, end_date, result_singles, result_fields, timing in future.result():
+                    writer.write(
+                        index, begin_date, end_date,
+                        single_vals=result_singles,
+                        fields=result_fields,
+                        timing=timing
+                    )
+
 def error_fullrun():
     if mpi.available:
         mpi.comm.Abort()
@@ -134,6 +264,125 @@ def pre_fullrun():
         # print(mpi.rank, ": am through")
 
 
+def bcast_array(arr):
+    # buffer based broadcast from the master, shape and dtype are sent first (pickled)
+    if mpi.am_master:
+        arr = np.ascontiguousarray(arr)
+        mpi.comm.bcast((arr.shape, arr.dtype.str), root=0)
+    else:
+        shape, dtype = mpi.comm.bcast(None, root=0)
+        arr = np.empty(shape, dtype=dtype)
+    mpi.comm.Bcast(arr, root=0)
+    return arr
+
+def broadcast_preprocessing(dl, grid_obj, *, grid_name):
+    """
+    the master did the preprocessing (if dl is not None) and created the grid,
+    the slaves receive the daily means, the base grid, the grid and the
+    remapping instead of reading the data and building the kd-trees themselves
+    """
+    assert mpi.available
+    with_data_loader = dl is not None
+
+    if with_data_loader:
+        daily_mean = bcast_array(dl.daily_mean if mpi.am_master else None)
+        base_lon_lat = bcast_array(dl.base_lon_lat if mpi.am_master else None)
+        remap_indices = bcast_array(grid_obj.remap_indices if mpi.am_master else None)
+    grid = bcast_array(grid_obj.grid if mpi.am_master else None)
+
+    if mpi.am_slave:
+        grid_info = {}
+        if with_data_loader:
+            dl.set_climatology(daily_mean, base_lon_lat)
+            grid_info = dict(
+                base_grid=base_lon_lat,
+                num_t=dl.data_load_info["time-length"],
+                remap_indices=remap_indices,
+            )
+        grid_partial = RunGrids[grid_name].value
+        grid_obj = grid_partial.func.from_arrays(
+            num_iterations=grid_partial.keywords["num_iterations"],
+            grid=grid,
+            inline_verb=True,
+            **grid_info
+        )
+    return grid_obj
+
+def find_previous_output(main_out_file_name):
+    """the output files of an interrupted run: the (unmerged) main file and the files of the mpi ranks"""
+    filenames = sorted(glob.glob(glob.escape(main_out_file_name) + ".mpi-*"))
+    if os.path.exists(main_out_file_name):
+        if ga.virtual_source_files(main_out_file_name):
+            # merged with virtual datasets, the data is in the files of the mpi ranks anyway
+            print(f"removing the virtual file '{main_out_file_name}' ... ", end="")
+            os.remove(main_out_file_name)
+            print("done")
+        else:
+            filenames.insert(0, main_out_file_name)
+    return filenames
+
+def completed_in_previous_output(filenames, date_pairs, *, run_info):
+    completed = np.zeros((len(date_pairs),), dtype=bool)
+    for filename in filenames:
+        header = ga.read_header(filename)
+        for key in CONTINUE_RUN_INFO_KEYS:
+            if key in header: # not recorded in older files
+                assert header[key] == run_info[key], f"'{filename}' was computed with {key} = {header[key]!r}, not {run_info[key]!r}"
+        with h5py.File(filename, "r") as in_file:
+            assert np.all(np.array(in_file["data/dates"]).view(ga.NUMPY_DATE_TYPE) == date_pairs), \
+                f"'{filename}' has different windows, use the same dates as before"
+            file_completed = ga.completed_windows(in_file)
+        assert not np.any(completed & file_completed), "overlapping data, how should I merge that?"
+        completed |= file_completed
+    return completed
+
+def split_indices(num_all, num_splits):
+    # split the indices into num_splits contiguous parts with lengths differing by at most one
+    split_width = num_all // num_splits
+    split_leftovers = num_all % num_splits
+    splits = np.zeros((num_splits + 1,), dtype=int)
+    splits[1:split_leftovers+1] = split_width + 1
+    splits[1+split_leftovers:] = split_width
+    return np.cumsum(splits)
+
+def merge_output(out_files):
+    # merge all data *.hdf5.mpi-* files (and what is left from a continued run) to a *.hdf5 file
+    if main_out_file_name in out_files and not args.virtual_merge:
+        # e.g. an extended run, add the new windows to it
+        ga.merge_results(
+            [name for name in out_files if name != main_out_file_name],
+            out_file_name=main_out_file_name,
+            delete_after=True,
+            append=True
+        )
+        return
+    if main_out_file_name in out_files:
+        # continued without mpi or the merged file of the previous run is continued with mpi
+        previous_file_name = next(
+            name for name in (f"{main_out_file_name}.mpi-previous-{n}" for n in range(len(out_files) + 1))
+            if not os.path.exists(name)
+        )
+        os.rename(main_out_file_name, previous_file_name)
+        out_files = [previous_file_name if name == main_out_file_name else name for name in out_files]
+    ga.merge_results(
+        out_files,
+        out_file_name=main_out_file_name,
+        delete_after=not args.virtual_merge,
+        virtual=args.virtual_merge
+    )
+    if args.virtual_merge and args.scratch_directory is not None:
+        # the virtual datasets would point back into the scratch directory
+        ga.compact_results(main_out_file_name, delete_sources=True)
+
+def merge_profile_output(profile_file_names):
+    # one profile and a text report of the profiled processes
+    base_name = os.path.splitext(main_out_file_name)[0]
+    print("merging the profiles ... ", end="")
+    if instr.merge_profiles(profile_file_names, out_file_name=base_name + ".prof", report_file_name=base_name + ".profile.txt"):
+        print(f"done, see '{base_name}.profile.txt'")
+    else:
+        print("nothing was profiled")
+
 def post_fullrun():
 
     print("running post_fullrun!")
@@ -143,6 +392,7 @@ def post_fullrun():
         final_status = {
             "status" : "done",
             "out-file-name" : out_file_name,
+            "profile-file-name" : profile_file_name,
         }
 
         if mpi.am_slave:
@@ -154,6 +404,7 @@ def post_fullrun():
             assert final_status["status"] == "done"
             mpi_out_files = []
             mpi_out_files.append(final_status["out-file-name"])
+            profile_file_names = [final_status["profile-file-name"]]
             for slave in range(1, mpi.size):
                 print(f"waiting that slave {slave} is done ... ", end="")
                 slave_final_status = mpi.comm.recv(source=slave) # receive from slave
@@ -161,14 +412,12 @@ def post_fullrun():
                 assert slave_final_status["status"] == "done"
                 print("received!")
                 mpi_out_files.append(slave_final_status["out-file-name"])
+                profile_file_names.append(slave_final_status["profile-file-name"])
             del slave, slave_final_status
 
-            # merge all data *.hdf5.mpi-* files to a *.hdf5 file
-            ga.merge_results(
-                mpi_out_files,
-                out_file_name=main_out_file_name,
-                delete_after=True
-            )
+            merge_output(mpi_out_files + stale_out_files)
+            if args.profile:
+                merge_profile_output([name for name in profile_file_names if name is not None])
 
             # if myconf.ON_CLUSTER:
             #     # copy it back from the scratch folder to the local file
@@ -178,6 +427,12 @@ def post_fullrun():
             #     print("done")
         else:
             raise mpi.MPIException("invalid mpi signature")
+    else:
+        if stale_out_files:
+            # continued without mpi
+            merge_output([out_file_name] + stale_out_files)
+        if profile_file_name is not None:
+            merge_profile_output([profile_file_name])
 
     if not mpi.available or mpi.am_master:
         # run the code either when done without mpi or as master (slaves should not)
@@ -208,6 +463,19 @@ class RunGrids(Enum):
         num_iterations=5
         )
 
+    # refined grids, use them with the 'out-of-core' correlation engine
+    icosahedral_6 = ft.partial(
+        ico.IcosahedralGrid,
+        num_iterations=6,
+        keep_graph=False
+    )
+
+    icosahedral_7 = ft.partial(
+        ico.IcosahedralGrid,
+        num_iterations=7,
+        keep_graph=False
+    )
+
     # icosahedral_without_ENSO_big = ft.partial(
     #     ico.IcosahedralGrid_PartRemoved,
     #     removed_location=ga.AreaCoordinates["nino-big-region"]["location"],
@@ -242,35 +510,131 @@ if __name__ == "__main__":
                         help="choose 'scipt-mode' from: " + ", ".join(available_script_modes))
 
     parser.add_argument("-c", "--continue", action="store_true", dest="cont",
-                        help="continue a computation from before")
+                        help="continue a computation from before, only the windows missing in the output file "
+                        "(or the *.mpi-* files) are computed, use the same arguments as before")
+    parser.add_argument("--extend", action="store_true",
+                        help="extend an existing output file to a later end date, only the new windows are computed")
+    parser.add_argument("--last-data-year", type=int, default=NCEP_NCAR.end_year, metavar="year",
+                        help="the last year of the SAT data, the default end date is its end; default: {}".format(NCEP_NCAR.end_year))
+    parser.add_argument("--climatology", choices=CLIMATOLOGY_POLICIES,
+                        help="'fixed' removes the seasonality with the daily means of the years used before "
+                        "(with --extend: the ones of the output file, else {}-{}), 'recompute' uses all years up to the last data year; "
+                        "default: fixed".format(NCEP_NCAR.begin_year, NCEP_NCAR.end_year))
     parser.add_argument("-r", "--reverse", action="store_true",
                         help="compute backwards in time, start in latest year")
     parser.add_argument("-o", "--output", type=str, metavar="file",
                         help="output file")
 
+    parser.add_argument("--correlation-engine", choices=sorted(AVAILABLE_CORRELATION_ENGINES),
+                        help="overwrite the correlation engine of the run-type, "
+                             "note that 'tiled' only caps the memory, it recomputes the tiles for every pass of the threshold selection and is slower than 'full'")
+    parser.add_argument("--memory-budget", type=int, metavar="MB",
+                        help="memory budget for the correlation tiles of the 'tiled' and 'out-of-core' correlation engines, default: {} MB".format(DEFAULT_RUN_INFO["memory-budget"]))
+
+    parser.add_argument("--output-layout", choices=sorted(ga.OUTPUT_LAYOUTS),
+                        help="storage layout of the result fields, default: {}".format(DEFAULT_RUN_INFO["output-layout"]))
+    parser.add_argument("--output-chunk-shape", type=int, nargs=2, metavar=("WINDOWS", "NODES"),
+                        help="chunk shape of the result fields for chunked layouts, default: {} {}".format(*DEFAULT_RUN_INFO["output-chunk-shape"]))
+    parser.add_argument("--virtual-merge", action="store_true",
+                        help="merge the output of the mpi ranks with HDF5 virtual datasets instead of copying, "
+                        "the *.mpi-* files have to be kept until 'python graph_analysis.py <file>' compacts it")
+    parser.add_argument("--write-batch-size", type=int, default=32, metavar="N",
+                        help="number of windows collected before they are written to the output file, default: 32")
+
+    parser.add_argument("--schedule", choices=["static", "dynamic"], default="static",
+                        help="with mpi, 'static' gives each process an equal part of the windows, with 'dynamic' the master "
+                        "hands out chunks of consecutive windows (getting smaller towards the end) whenever a process is ready; "
+                        "default: static")
+    parser.add_argument("--min-chunk-size", type=int, default=ws.DEFAULT_MIN_CHUNK_SIZE, metavar="N",
+                        help="smallest number of consecutive windows handed out by the dynamic schedule (and to the --workers), default: {}".format(ws.DEFAULT_MIN_CHUNK_SIZE))
+
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="without mpi, compute the windows in N processes on this machine, "
+                        "they share the remapped data through shared memory; default: 1")
+
+    parser.add_argument("--pipeline", action="store_true",
+                        help="compute the graph measures of a window in other processes while the correlations of the next windows are computed")
+    parser.add_argument("--metric-workers", type=int, default=2, metavar="N",
+                        help="number of processes or threads computing the graph measures with --pipeline, default: 2")
+    parser.add_argument("--metric-executor", choices=sorted(METRIC_EXECUTORS),
+                        help="run the graph measures with --pipeline in processes or threads, default: threads with mpi, else processes")
+    parser.add_argument("--pipeline-depth", type=int, metavar="N",
+                        help="maximal number of windows waiting for or in the graph measures with --pipeline, default: twice the metric workers")
+
+    parser.add_argument("--no-timing-log", action="store_false", dest="timing_log",
+                        help="don't write the timing of the stages of each window to '<output>{}' (with mpi: one file per process), "
+                        "it is in the 'timing' group of the output file anyway, see instrumentation.py".format(instr.TIMING_LOG_SUFFIX))
+
+    parser.add_argument("--profile", action="store_true",
+                        help="run cProfile around the windows of the process (in the main thread, so not the --workers), "
+                        "the profiles are merged into '<output>.prof' and '<output>.profile.txt' at the end")
+    parser.add_argument("--profile-ranks", type=int, nargs="+", metavar="rank",
+                        help="profile only these mpi processes, default: all")
+    parser.add_argument("--profile-windows", type=int, default=10, metavar="N",
+                        help="profile only the first N windows of each process, default: 10")
+
     parser.add_argument("--grid", default=RunGrids.icosahedral.name, choices=grid_choices,
                         help="set which grid should be used")
 
     parser.add_argument("--begin-date", type=parse_date, default=default_begin_date, metavar="yyyy-mm-dd",
                         help="starting date, default: {}".format(default_begin_date))
-    parser.add_argument("--end-date", type=parse_date, default=default_end_date, metavar="yyyy-mm-dd",
-                        help="starting date, there should be at least one year difference to the begin date; default: {}".format(default_end_date))
+    parser.add_argument("--end-date", type=ft.partial(parse_date, last_date=dt.date.max), metavar="yyyy-mm-dd",
+                        help="starting date, there should be at least one year difference to the begin date; default: end of the last data year ({})".format(default_end_date))
 
     parser.add_argument("--scratch-directory", metavar="directory",
                         help="a directory, where the temporary data should be saved")
 
     parser.add_argument("--data-directory", metavar="directory", default="data/",
                         help="the directory where the SAT data can be found, default './data'")
+    parser.add_argument("--climatology-cache-directory", metavar="directory",
+                        help="where the cache of the daily means is kept, default: the data directory")
+    parser.add_argument("--no-climatology-cache", action="store_false", dest="climatology_cache",
+                        help="always compute the daily means from the SAT data")
+    parser.add_argument("--broadcast-preprocessing", action="store_true",
+                        help="with mpi, only the master computes the daily means and creates the grid, the other processes receive them")
+    parser.add_argument("--shared-data", action="store_true",
+                        help="with mpi, the first process on each node remaps the data of all years once into memory shared by all processes of the node")
+    parser.add_argument("--data-store", metavar="file",
+                        help="use the remapped and deseasonalized data from a file created with './data_store.py' instead of loading the SAT data")
 
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
 
     run_type = args.run_type
 
-    assert not args.cont, "conintuing not yet implemented"
+    if args.workers < 1:
+        parser.error("the number of workers has to be positive")
+    if args.workers > 1 and mpi.available:
+        parser.error("use either mpi or --workers")
+
+    if args.pipeline and args.workers > 1:
+        parser.error("use either --pipeline or --workers")
+    if args.metric_workers < 1:
+        parser.error("the number of metric workers has to be positive")
+    if args.metric_executor is None:
+        args.metric_executor = "thread" if mpi.available else "process"
+    if args.pipeline_depth is None:
+        args.pipeline_depth = 2 * args.metric_workers
+    if args.pipeline_depth < 1:
+        parser.error("the pipeline depth has to be positive")
+    if args.profile and args.workers > 1:
+        parser.error("--profile only profiles the process itself, not the --workers")
+    if args.shared_data and not mpi.available:
+        parser.error("--shared-data needs mpi, use --workers without it")
+    if args.shared_data and args.data_store is not None:
+        parser.error("the data store is memory-mapped and shared by the processes of a node anyway, don't use --shared-data with it")
+
+    if args.end_date is None:
+        args.end_date = dt.date(args.last_data_year, 12, 31)
+    if args.end_date > dt.date(args.last_data_year, 12, 31):
+        parser.error("the end date {} is after the last data year {}".format(args.end_date, args.last_data_year))
+    if args.climatology is None:
+        args.climatology = "fixed"
+    if args.extend:
+        args.cont = True # the new windows are the missing ones of the extended file
 
     if args.script_mode == paper_mode:
-        assert run_type == "daily", "use the 'paper' mode with run-type daily to reproduce the results precisely"
+        assert run_type in ["daily", "daily-incremental"], "use the 'paper' mode with run-type daily to reproduce the results precisely"
         pass # default configuration of graph_analysis.py is setup for that
     elif args.script_mode == modularity_mode:
         assert run_type == "normal", "use with run_type normal to avoid excessive run times"
@@ -307,8 +671,21 @@ if __name__ == "__main__":
         # do everything in the scratch directory and then copy it back at the end
         local_file = args.output
         args.output = os.path.join(args.scratch_directory, os.path.basename(args.output))
-        if os.path.exists(local_file):
+        if os.path.exists(local_file) and not args.cont:
             parser.error("'{}' exists already".format(local_file))
+        if os.path.exists(local_file):
+            # continue the local file, the output is searched for in the scratch directory only
+            both_exist = os.path.exists(args.output)
+            if mpi.available:
+                both_exist = mpi.comm.bcast(both_exist, root=0) # decided before the master copies
+            if both_exist:
+                parser.error("'{}' and '{}' exist both, remove the one not to continue".format(local_file, args.output))
+            if not mpi.available or mpi.am_master:
+                print(f"{local_file} --> {args.output} ... ", end="", flush=True)
+                shutil.copy2(local_file, args.output)
+                print("done")
+            if mpi.available:
+                mpi.comm.barrier()
         print(f"\nusing: {args.output}")
 
     # if myconf.ON_CLUSTER:
@@ -321,18 +698,54 @@ if __name__ == "__main__":
 
     main_out_file_name = out_file_name = args.output
 
-    if os.path.exists(out_file_name):
+    # when continuing, the existing files are checked and appended to later
+    if os.path.exists(out_file_name) and not args.cont:
         parser.error("'{}' exists already".format(out_file_name))
 
     if mpi.available:
         out_file_name += ".mpi-{}".format(mpi.rank)
-        if os.path.exists(out_file_name):
+        if os.path.exists(out_file_name) and not args.cont:
             parser.error("'{}' exists already".format(out_file_name))
         print(f"\nusing: {out_file_name}")
 
     run_info = DEFAULT_RUN_INFO
     run_info.update(RUN_INFOS[run_type])
 
+    if args.correlation_engine is not None:
+        run_info["correlation-engine"] = args.correlation_engine
+    if args.memory_budget is not None:
+        run_info["memory-budget"] = args.memory_budget
+    if args.output_layout is not None:
+        run_info["output-layout"] = args.output_layout
+    if args.output_chunk_shape is not None:
+        run_info["output-chunk-shape"] = tuple(args.output_chunk_shape)
+    run_info["grid"] = args.grid # recorded in the header of the output file
+
+    if args.extend and not os.path.exists(main_out_file_name):
+        parser.error("'{}' does not exist, nothing to extend".format(main_out_file_name))
+    if args.climatology == "recompute":
+        preprocessing_years = (NCEP_NCAR.begin_year, args.last_data_year)
+    elif args.extend:
+        header = ga.read_header(main_out_file_name)
+        preprocessing_years = (header.get("preprocessing-begin-year", NCEP_NCAR.begin_year), header.get("preprocessing-end-year", NCEP_NCAR.end_year))
+        del header
+    else:
+        preprocessing_years = (NCEP_NCAR.begin_year, NCEP_NCAR.end_year)
+    run_info["preprocessing-begin-year"], run_info["preprocessing-end-year"] = map(int, preprocessing_years)
+
+    assert run_info["correlation-engine"] in AVAILABLE_CORRELATION_ENGINES, f"unknown correlation engine {run_info['correlation-engine']!r}"
+    engine_options = {}
+    if run_info["correlation-engine"] in ["tiled", "out-of-core"]:
+        engine_options["memory_budget"] = run_info["memory-budget"] * 2**20
+    if run_info["correlation-engine"] == "out-of-core":
+        engine_options["directory"] = args.scratch_directory # the correlation tiles are saved there
+    corr_engine = AVAILABLE_CORRELATION_ENGINES[run_info["correlation-engine"]](
+        window_length=run_info["correlation-time"],
+        **engine_options
+    )
+    # consecutive windows have similar thresholds, so start searching around the previous one
+    link_threshold = LinkThreshold(run_info["cut-off-percentage"], warm_start=True)
+
     data_directory = args.data_directory
     data_info = {
         "base-name"  : "air",
@@ -343,32 +756,81 @@ if __name__ == "__main__":
 
     pre_fullrun() # wait that all processes started up properly
 
-    dl = DataLoader(
-        data_directory,
-        data_load_info = data_info,
-        preprocessing_begin_year=NCEP_NCAR.begin_year,
-        preprocessing_end_year=NCEP_NCAR.end_year,
-        remove_seasonality=True,
-        surrogates=False
-    )
+    # with --broadcast-preprocessing, the slaves get the daily means and the grid from the master
+    broadcasting = mpi.available and args.broadcast_preprocessing
+    receiving = broadcasting and mpi.am_slave
+
+    if args.data_store is None:
+        dl = DataLoader(
+            data_directory,
+            data_load_info = data_info,
+            preprocessing_begin_year=run_info["preprocessing-begin-year"],
+            preprocessing_end_year=run_info["preprocessing-end-year"],
+            remove_seasonality=True,
+            surrogates=False,
+            cache=args.climatology_cache,
+            cache_directory=args.climatology_cache_directory,
+            preprocess=not receiving
+        )
+    else:
+        dl = None
 
     assert run_info["grid-type"] == "icosahedral", "anything else not implemented here, but can be easily extended"
-    print("generating icosahedral grid ... ", end="")
-    grid_obj = RunGrids[args.grid].value( # choose the necessary grid from RunGrids (as given in the command line arguments
-        base_grid=dl.base_lon_lat,
-        num_t=data_info["time-length"],
-        inline_verb=True,
-    )
-    print("done")
-
-    dh = DataHandler(
-        dl.load,
-        num_t = data_info["time-length"],
-        info=data_info["base-name"]+"-h",
-        base_grid_shape=data_info["grid-shape"],
-        grid_style="icosahedral",
-        irregular_grid=grid_obj
-    )
+    if receiving:
+        grid_obj = None
+    else:
+        base_grid_info = {} # no remapping necessary with a data store
+        if dl is not None:
+            base_grid_info = dict(
+                base_grid=dl.base_lon_lat,
+                num_t=data_info["time-length"],
+            )
+        print("generating icosahedral grid ... ", end="")
+        grid_obj = RunGrids[args.grid].value( # choose the necessary grid from RunGrids (as given in the command line arguments
+            inline_verb=True,
+            **base_grid_info
+        )
+        print("done")
+
+    if broadcasting:
+        print("broadcasting the preprocessing results and the grid ... ", end="")
+        grid_obj = broadcast_preprocessing(dl, grid_obj, grid_name=args.grid)
+        print("done")
+
+    shared_window = None
+    if args.shared_data:
+        # one copy of the remapped data per node instead of a DataHandler per process
+        print(f"remapping {args.begin_date.year} - {args.end_date.year} into the shared memory of the node ... ", end="")
+        dh, shared_window = mpi_shared_data_store(
+            mpi.comm,
+            data_loader=dl,
+            grid_obj=grid_obj,
+            begin_year=args.begin_date.year,
+            end_year=args.end_date.year,
+            num_t=data_info["time-length"],
+            info=data_info["base-name"]+"-n"
+        )
+        dl = None # not needed anymore, frees the daily means
+        print("done")
+    elif args.data_store is None:
+        dh = DataHandler(
+            dl.load,
+            num_t = data_info["time-length"],
+            info=data_info["base-name"]+"-h",
+            base_grid_shape=data_info["grid-shape"],
+            grid_style="icosahedral",
+            irregular_grid=grid_obj
+        )
+    else:
+        print(f"opening data store '{args.data_store}' ... ", end="")
+        dh, store_info = open_data_store(args.data_store)
+        assert store_info.get("grid") == args.grid, f"data store was created for the grid {store_info.get('grid')!r}"
+        assert store_info["base-name"] == data_info["base-name"]
+        assert store_info["time-length"] == data_info["time-length"]
+        assert store_info["remove-seasonality"]
+        assert (store_info["preprocessing-begin-year"], store_info["preprocessing-end-year"]) == (run_info["preprocessing-begin-year"], run_info["preprocessing-end-year"])
+        assert dh.grid_shape == grid_obj.grid.shape[:1]
+        print("done")
 
     all_date_pairs = np.asarray(get_date_pairs_list(
         args.begin_date,
@@ -377,32 +839,69 @@ if __name__ == "__main__":
         time_between=run_info["correlation-time"]
     ), dtype="<M8[D]")
 
-    print("preparing output file '{}' ... ".format(out_file_name), end="")
-    ga.prepare_output_file(
-        out_file_name, all_date_pairs, dh.grid_shape,
-        run_info=run_info
-    )
-    print("done")
+    previously_completed = np.zeros((len(all_date_pairs),), dtype=bool)
+    stale_out_files = [] # files of the previous run that are not written to now, they are merged at the end
+    if args.cont:
+        # the master scans the files before anyone opens them for writing
+        if (mpi.am_master or not mpi.available) and args.extend:
+            extend_header = {key: run_info[key] for key in ["preprocessing-begin-year", "preprocessing-end-year"]}
+            if (ga.read_header(main_out_file_name).get("preprocessing-end-year", NCEP_NCAR.end_year) != run_info["preprocessing-end-year"]):
+                # the windows before were computed with other daily means
+                with h5py.File(main_out_file_name, "r") as in_file:
+                    extend_header["climatology-changed-at-window"] = len(in_file["data/dates"])
+            ga.extend_output_file(main_out_file_name, all_date_pairs, header=extend_header)
+            del extend_header
+        if mpi.am_master or not mpi.available:
+            print("scanning the output of the previous run ... ", end="")
+            previous_out_files = find_previous_output(main_out_file_name)
+            previously_completed = completed_in_previous_output(previous_out_files, all_date_pairs, run_info=run_info)
+            print("done")
+        if mpi.available:
+            previous_out_files, previously_completed = mpi.comm.bcast(
+                (previous_out_files, previously_completed) if mpi.am_master else None, root=0)
+        if mpi.available:
+            current_out_files = [f"{main_out_file_name}.mpi-{rank}" for rank in range(mpi.size)]
+        else:
+            current_out_files = [main_out_file_name]
+        stale_out_files = [filename for filename in previous_out_files if filename not in current_out_files]
+        print(f"continuing: {np.count_nonzero(previously_completed)}/{len(all_date_pairs)} windows have been computed before, "
+              f"found {len(previous_out_files)} file(s)")
+
+    if os.path.exists(out_file_name):
+        assert args.cont # checked by completed_in_previous_output
+        print("appending to the existing output file '{}'".format(out_file_name))
+    else:
+        print("preparing output file '{}' ... ".format(out_file_name), end="")
+        ga.prepare_output_file(
+            out_file_name, all_date_pairs, dh.grid_shape,
+            run_info=run_info
+        )
+        print("done")
 
     iterator = enumerate(all_date_pairs)
 
     if args.reverse:
         iterator = reversed(iterator)
 
-    iterator = list(iterator) # make a list out of it just in case we use mpi
+    # make a list out of it just in case we use mpi, only the missing windows when continuing
+    iterator = [(index, date_pair) for index, date_pair in iterator if not previously_completed[index]]
 
     print()
-    if mpi.available:
+    if mpi.available and args.schedule == "dynamic":
+        assert mpi.size > 1, "the dynamic schedule needs at least one process besides the master"
+        print(f"mpi is available and my rank is {mpi.rank}. ", end="", flush=True)
+        if mpi.am_master:
+            print(f"I am handing out {len(iterator)} windows.")
+            ws.serve_windows(iterator, comm=mpi.comm, num_workers=mpi.size - 1, min_chunk_size=args.min_chunk_size)
+            iterator = [] # all done by the others
+        else:
+            print("I am working on the windows I get from the master.")
+            iterator = ws.requested_windows(comm=mpi.comm)
+    elif mpi.available:
         # seperate out part of list to be processed (iterator) that is needed for this mpi_run
         print(f"mpi is available and my rank is {mpi.rank}. ", end="", flush=True)
-        num_splits = mpi.size
         num_all = len(iterator)
-        split_width = num_all // num_splits
-        split_leftovers = num_all % num_splits
-        splits = np.zeros((num_splits + 1,), dtype=int)
-        splits[1:split_leftovers+1] = split_width + 1
-        splits[1+split_leftovers:] = split_width
-        splits = np.cumsum(splits)
+        splits = split_indices(num_all, mpi.size)
         begin_index, end_index = splits[mpi.rank], splits[mpi.rank+1]
         iterator = iterator[begin_index : end_index]
         print(f"I am working from {begin_index} to {end_index} ({end_index-begin_index}/{num_all}).")
@@ -410,14 +909,79 @@ if __name__ == "__main__":
         print("No mpi found!")
     print()
 
-    assert dl.preprocessing_done
-
-    for current_index, (current_begin_date, current_end_date) in iterator:
-        analyze(
-            current_index, current_begin_date, current_end_date,
+    assert dl is None or dl.preprocessing_done
+
+    profile_file_name = None
+    if args.profile and (not mpi.available or args.profile_ranks is None or mpi.rank in args.profile_ranks):
+        profile_file_name = os.path.splitext(main_out_file_name)[0] + (f".rank-{mpi.rank}" if mpi.available else "") + ".prof"
+        print(f"profiling the first {args.profile_windows} windows into '{profile_file_name}'")
+        profiler = cProfile.Profile()
+        iterator = instr.profiled_windows(iterator, profiler, max_windows=args.profile_windows)
+
+    timing_log = None
+    if args.timing_log:
+        # not *.hdf5.mpi-*, these are the output files of the processes
+        timing_log_name = os.path.splitext(main_out_file_name)[0] + (f".rank-{mpi.rank}" if mpi.available else "") + instr.TIMING_LOG_SUFFIX
+        print(f"writing the timing to '{timing_log_name}'")
+        timing_log = instr.TimingLog(timing_log_name, rank=mpi.rank if mpi.available else 0)
+
+    if args.workers > 1:
+        shared_memory = None
+        if args.data_store is None and iterator:
+            # the workers read the windows from one copy of the remapped data instead of each loading years
+            years = [date.astype(object).year for _, date_pair in iterator for date in date_pair]
+            print(f"remapping {min(years)} - {max(years)} into shared memory ... ", end="")
+            dh, shared_memory = shared_data_store(
+                data_loader=dl,
+                grid_obj=grid_obj,
+                begin_year=min(years),
+                end_year=max(years),
+                info=data_info["base-name"]+"-m"
+            )
+            print("done")
+        # (a data store is memory-mapped, so it is shared by the workers anyway)
+        print(f"computing {len(iterator)} windows with {args.workers} worker processes")
+        try:
+            run_workers(
+                iterator,
+                num_workers=args.workers,
+                run_info=run_info,
+                writer_factory=ft.partial(ga.ResultWriter, out_file_name, batch_size=args.write_batch_size, timing_log=timing_log),
+                min_chunk_size=args.min_chunk_size
+            )
+        finally:
+            # also if a worker failed, the segment would stay in /dev/shm otherwise
+            if shared_memory is not None:
+                del dh
+                shared_memory.unlink()
+                shared_memory.close()
+    elif args.pipeline:
+        print(f"computing the windows pipelined, the graph measures with {args.metric_workers} workers ({args.metric_executor})")
+        run_pipelined(
+            iterator,
             run_info=run_info,
-            out_file_name=out_file_name
+            writer_factory=ft.partial(ga.ResultWriter, out_file_name, batch_size=args.write_batch_size, timing_log=timing_log),
+            metric_executor=args.metric_executor,
+            metric_workers=args.metric_workers,
+            depth=args.pipeline_depth
         )
+    else:
+        # closed (and the buffered windows written) also if a window fails, so they are kept for --continue
+        with ga.ResultWriter(out_file_name, batch_size=args.write_batch_size, timing_log=timing_log) as writer:
+            for current_index, (current_begin_date, current_end_date) in iterator:
+                analyze(
+                    current_index, current_begin_date, current_end_date,
+                    run_info=run_info,
+                    writer=writer
+                )
+    corr_engine.close()
+    if profile_file_name is not None:
+        profiler.dump_stats(profile_file_name)
+    if timing_log is not None:
+        timing_log.close()
+    if shared_window is not None:
+        del dh
+        shared_window.Free() # collectively by the processes of the node
 
     post_fullrun()
 
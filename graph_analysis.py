@@ -1,12 +1,15 @@
 
 import haversine as hav
 import helpers
+import instrumentation as instr
 import locations as locs
 
 import functools as ft
 import igraph as ig
 import h5py
 import numpy as np
+import queue
+import threading
 import time
 import os
 
@@ -43,6 +46,11 @@ AVAILABLE_COMMUNITY_ALGORITHMS = {
 
 MODULARITY_PREFIX = "modularity-"
 
+# The published results were computed with link lengths from 'haversine.distance'
+# where latitude and longitude are exchanged (see 'get_cumulative_distances_reference').
+# Keep this True to reproduce them, set it to False for the actual great-circle lengths.
+EXCHANGED_LON_LAT_DISTANCES = True
+
 AreaCoordinates = {
 
 "nino-3-4-region" : dict(
@@ -88,6 +96,65 @@ AreaCoordinates = {
 
 } # close AreaCoordinates dict
 
+# storage layouts of the datasets in the output files, chosen with run_info["output-layout"]
+OUTPUT_LAYOUTS = {
+    "contiguous" : dict(),
+    "chunked"    : dict(chunks=True),
+    "gzip"       : dict(chunks=True, compression="gzip", compression_opts=4, shuffle=True),
+    "lzf"        : dict(chunks=True, compression="lzf", shuffle=True),
+}
+DEFAULT_OUTPUT_LAYOUT = "contiguous"
+# (windows, nodes), a compromise between reading single windows (e.g. for composites)
+# and reading the time series of a region
+DEFAULT_FIELD_CHUNK_SHAPE = (32, 1024)
+ARRAY_CHUNK_LENGTH = 4096
+
+# h5py's default, all results used to be stored like this
+DEFAULT_RESULT_DTYPE = "<f4"
+# results counting nodes are stored as unsigned integers (with run_info["compact-output"]),
+# missing windows are then given by the 'data/completed' mask instead of NaN
+COUNT_RESULT_FIELDS = ["degree-field"]
+
+def _result_dtype(name, field_shape, compact):
+    if compact and name in COUNT_RESULT_FIELDS:
+        return np.min_scalar_type(field_shape[-1]) # a degree is smaller than the number of nodes
+    return np.dtype(DEFAULT_RESULT_DTYPE)
+
+def _fillvalue(dtype):
+    return np.nan if np.issubdtype(dtype, np.floating) else 0
+
+def _consecutive_runs(indices):
+    # split sorted indices into (begin, end) of runs of consecutive values
+    indices = np.asarray(indices)
+    if not indices.size:
+        return []
+    run_starts = np.flatnonzero(np.diff(indices) != 1) + 1
+    return [(run[0], run[-1] + 1) for run in np.split(indices, run_starts)]
+
+def _dataset_layout(layout_name, shape, chunk_shape):
+    assert layout_name in OUTPUT_LAYOUTS, f"unknown output layout {layout_name!r}"
+    layout = dict(OUTPUT_LAYOUTS[layout_name])
+    if layout.get("chunks"):
+        # chunks cannot be larger than the dataset
+        layout["chunks"] = tuple(max(1, min(int(c), s)) for c, s in zip(chunk_shape, shape))
+        # chunked datasets can grow when the run is extended (see 'extend_output_file')
+        layout["maxshape"] = (None,) + tuple(shape[1:])
+    return layout
+
+def _header_value(value):
+    # h5py attributes cannot be None or nested
+    if value is None:
+        return "None"
+    if isinstance(value, (list, tuple)):
+        return np.array(value)
+    return value
+
+def read_header(filename):
+    """the run_info recorded in the header of an output file"""
+    with h5py.File(filename, "r") as in_file:
+        return {key: (None if isinstance(value, str) and value == "None" else value)
+                for key, value in in_file["header"].attrs.items()}
+
 ######################################################################################################################
 #TODO: These output file operations should be combined in a class, instead of using global variables
 ######################################################################################################################
@@ -106,12 +173,25 @@ def prepare_output_file(filename,
     dataset_array_shape = (run_length,)
     dataset_field_shape = (run_length, ) + field_shape
 
+    layout_name = run_info.get("output-layout", DEFAULT_OUTPUT_LAYOUT)
+    field_chunk_shape = tuple(run_info.get("output-chunk-shape", DEFAULT_FIELD_CHUNK_SHAPE))
+    assert len(field_chunk_shape) == len(dataset_field_shape)
+    field_layout = _dataset_layout(layout_name, dataset_field_shape, field_chunk_shape)
+    array_layout = _dataset_layout(layout_name, dataset_array_shape, (ARRAY_CHUNK_LENGTH,))
+
     # create basic structure of the hdf5 file
     with h5py.File(filename, "w") as out_file:
         out_data = out_file.create_group("data")
         out_header = out_file.create_group("header")
-
-        out_data.create_dataset("dates", (run_length, 2), dtype=H5PY_DATE_TYPE, fillvalue=np.nan)
+        for key, value in run_info.items():
+            out_header.attrs[key] = _header_value(value)
+        # record the layout actually used, the defaults might change
+        out_header.attrs["output-layout"] = layout_name
+        out_header.attrs["output-chunk-shape"] = np.array(field_layout.get("chunks", ()), dtype=int)
+
+        dates_layout = _dataset_layout(layout_name, (run_length, 2), (ARRAY_CHUNK_LENGTH, 2))
+        dates_layout = {key: value for key, value in dates_layout.items() if key in ["chunks", "maxshape"]}
+        out_data.create_dataset("dates", (run_length, 2), dtype=H5PY_DATE_TYPE, fillvalue=np.nan, **dates_layout)
         out_data["dates"][:,:] = date_pairs.view(H5PY_DATE_TYPE)
         # h5py cannot do dates, so this is a workaround
         # http://stackoverflow.com/questions/23570632/store-datetimes-in-hdf5-with-h5py
@@ -119,10 +199,21 @@ def prepare_output_file(filename,
         out_fields = out_data.create_group("fields")
         out_arrays = out_data.create_group("arrays")
 
+        # marks the windows that have been written
+        out_data.create_dataset("completed", dataset_array_shape, dtype=bool, fillvalue=False, **array_layout)
+
+        # instrumentation of the windows, see instrumentation.py
+        out_timing = out_file.create_group("timing")
+        for name in instr.TIMING_DATASETS:
+            out_timing.create_dataset(name, dataset_array_shape, dtype="<f8", fillvalue=np.nan, **array_layout)
+
+        compact = run_info.get("compact-output", False)
         for fieldname in RESULT_FIELDS:
-            out_fields.create_dataset(fieldname, dataset_field_shape, fillvalue=np.nan)
+            dtype = _result_dtype(fieldname, field_shape, compact)
+            out_fields.create_dataset(fieldname, dataset_field_shape, dtype=dtype, fillvalue=_fillvalue(dtype), **field_layout)
         for arrayname in RESULT_ARRAYS:
-            out_arrays.create_dataset(arrayname, dataset_array_shape, fillvalue=np.nan)
+            dtype = _result_dtype(arrayname, (), compact)
+            out_arrays.create_dataset(arrayname, dataset_array_shape, dtype=dtype, fillvalue=_fillvalue(dtype), **array_layout)
 
 def save_results(index, begin_date, end_date,
                  *,
@@ -141,8 +232,8 @@ def save_results(index, begin_date, end_date,
 
         assert set(RESULT_ARRAYS).issubset(single_vals)
         assert set(RESULT_FIELDS).issubset(fields)
-        assert None not in list(single_vals.values())
-        assert None not in list(fields.values())
+        assert all(value is not None for value in single_vals.values())
+        assert all(value is not None for value in fields.values())
 
         out_file_begin_date, out_file_end_date = np.array(out_file["data/dates"][index]).view(NUMPY_DATE_TYPE)
         # h5py cannot do dates, so this is a workaround
@@ -158,58 +249,260 @@ def save_results(index, begin_date, end_date,
         for fieldname in RESULT_FIELDS:
             out_file["data/fields"][fieldname][index] = fields[fieldname]
 
+        if "completed" in out_file["data"]:
+            out_file["data/completed"][index] = True
+
+
+class ResultWriter(object):
+    """
+    keeps the output file (created by 'prepare_output_file') open for the whole run,
+    buffers the results of 'batch_size' windows and writes them as slabs of
+    consecutive windows
+
+    with 'background', the writing is done by a separate thread, so the
+    computation doesn't have to wait for the file system; only that thread
+    touches the file after opening it
+    """
+
+    def __init__(self, out_file_name, *, batch_size=32, background=True, timing_log=None):
+        assert batch_size > 0
+        self.out_file_name = out_file_name
+        self.batch_size = batch_size
+        self.background = background
+        self.timing_log = timing_log # an instrumentation.TimingLog, gets the timing of the windows and the writing
+
+        self.out_file = h5py.File(out_file_name, "a") # append, so the data from before doesn't get overwritten
+        assert set(RESULT_ARRAYS) == set(self.out_file["data/arrays"])
+        assert set(RESULT_FIELDS) == set(self.out_file["data/fields"])
+        self.dates = np.array(self.out_file["data/dates"]).view(NUMPY_DATE_TYPE)
+        # h5py cannot do dates, so this is a workaround
+        # http://stackoverflow.com/questions/23570632/store-datetimes-in-hdf5-with-h5py
+
+        self.buffer = []
+        self.error = None
+        self.closed = False
+        if self.background:
+            self.queue = queue.Queue(maxsize=2) # if the writing can't keep up, the computation has to wait eventually
+            self.thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, index, begin_date, end_date,
+              *,
+              single_vals,
+              fields,
+              timing=None):
+        assert not self.closed
+        self._check_error()
+
+        assert isinstance(single_vals, dict)
+        assert isinstance(fields, dict)
+        assert set(RESULT_ARRAYS).issubset(single_vals)
+        assert set(RESULT_FIELDS).issubset(fields)
+        assert all(value is not None for value in single_vals.values())
+        assert all(value is not None for value in fields.values())
+
+        # check that it's the correct corresponding dates
+        assert self.dates[index, 0] == begin_date
+        assert self.dates[index, 1] == end_date
+
+        if timing is not None and self.timing_log is not None:
+            self.timing_log.write(timing, kind="window")
+
+        self.buffer.append((index, single_vals, fields, timing))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        if self.background:
+            self.queue.put(batch)
+        else:
+            self._write_batch(batch)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.closed = True
+            if self.background:
+                self.queue.put(None) # tells the thread to stop
+                self.thread.join()
+            self.out_file.close()
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise IOError(f"writing to '{self.out_file_name}' failed") from self.error
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue # drop everything after an error, it is raised in the main thread
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.error = e
+
+    def _write_batch(self, batch):
+        values = {}
+        with instr.measure(values, "write"):
+            self._write_slabs(batch)
+        if self.timing_log is not None:
+            self.timing_log.write(dict(values, windows=len(batch), **{"max-rss": instr.max_rss()}), kind="write")
+
+    def _write_slabs(self, batch):
+        batch = sorted(batch, key=lambda result: result[0])
+        indices = [result[0] for result in batch]
+        # split into runs of consecutive windows, each is written as one slab
+        k = 0
+        for i0, i1 in _consecutive_runs(indices):
+            run = batch[k : k + i1 - i0]
+            k += i1 - i0
+            for arrayname in RESULT_ARRAYS:
+                self.out_file["data/arrays"][arrayname][i0:i1] = np.array([result[1][arrayname] for result in run])
+            for fieldname in RESULT_FIELDS:
+                self.out_file["data/fields"][fieldname][i0:i1] = np.array([result[2][fieldname] for result in run])
+            if "timing" in self.out_file and any(result[3] is not None for result in run):
+                for name in instr.TIMING_DATASETS:
+                    self.out_file["timing"][name][i0:i1] = [np.nan if result[3] is None else result[3].get(name, np.nan) for result in run]
+            self.out_file["data/completed"][i0:i1] = True # after the data, so an interrupted write is not marked
+        self.out_file.flush()
+
+
+def completed_windows(in_file):
+    """boolean mask of the windows that have been computed in an opened output file"""
+    if "completed" in in_file["data"]:
+        return np.array(in_file["data/completed"], dtype=bool)
+    # older files mark the missing windows by NaN only
+    completed = np.zeros((len(in_file["data/dates"]),), dtype=bool)
+    for arrayname in in_file["data/arrays"]:
+        completed |= ~ np.isnan(in_file["data/arrays"][arrayname])
+    for fieldname in in_file["data/fields"]:
+        completed |= ~ np.isnan(in_file["data/fields"][fieldname][:, 0])
+    return completed
+
+def read_results(in_file):
+    """
+    read the arrays and fields of an opened output file, integer results are
+    converted to floating point and missing windows are set to NaN, like before
+    """
+    completed = completed_windows(in_file)
+
+    def _read(dataset, float_dtype):
+        data = np.array(dataset)
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(float_dtype)
+            data[~completed] = np.nan
+        return data
+
+    arrays = {key: _read(in_file["data/arrays"][key], np.float64) for key in in_file["data/arrays"]}
+    # single precision keeps the memory small and is exact for counts up to 2**24
+    fields = {key: _read(in_file["data/fields"][key], np.float32) for key in in_file["data/fields"]}
+    return arrays, fields
+
+def _result_file_info(filename):
+    # the run_info (with the layout) and the structure of an output file
+    run_info = read_header(filename)
+    if "output-chunk-shape" in run_info and not len(run_info["output-chunk-shape"]):
+        del run_info["output-chunk-shape"] # contiguous
+    with h5py.File(filename, "r") as in_file:
+        dates = np.array(in_file["data/dates"])
+        result_arrays = list(in_file["data/arrays"])
+        result_fields = list(in_file["data/fields"])
+        if result_fields:
+            field_shape = np.shape(in_file["data/fields"][result_fields[0]])[1:]
+        else:
+            field_shape = ()
+    return run_info, dates, result_arrays, result_fields, field_shape
+
+def _timing_names(*h5files):
+    # the timing datasets present in all (opened) files, older files don't have them
+    return [name for name in instr.TIMING_DATASETS if all(name in h5file.get("timing", {}) for h5file in h5files)]
+
+def _copy_completed(filenames, out_file, *, verbose=1):
+    # copy the completed windows of the files into the opened 'out_file', its windows may extend theirs
+    out_dates = np.array(out_file["data/dates"])
+    out_completed = completed_windows(out_file)
+    for filename in filenames:
+        if verbose:
+            print("start merging", filename, "into", out_file.filename)
+        with h5py.File(filename, "r") as in_file:
+            dates = np.array(in_file["data/dates"])
+            assert np.all(out_dates[:len(dates)] == dates)
+            completed = np.zeros_like(out_completed)
+            completed[:len(dates)] = completed_windows(in_file)
+            assert not np.any(out_completed & completed), "overlapping data, how should I merge that?"
+            runs = _consecutive_runs(np.flatnonzero(completed))
+            for groupname, names in [("data/arrays", RESULT_ARRAYS), ("data/fields", RESULT_FIELDS), ("timing", _timing_names(in_file, out_file))]:
+                for name in names:
+                    if verbose:
+                        print("    merging", name)
+                    for i0, i1 in runs:
+                        out_file[groupname][name][i0:i1] = in_file[groupname][name][i0:i1]
+            out_completed |= completed
+    out_file["data/completed"][:] = out_completed
 
 def merge_results(filenames,
                   *,
                   out_file_name,
                   verbose=1,
-                  delete_after=False):
+                  delete_after=False,
+                  virtual=False,
+                  append=False):
+    """
+    merge the output files of the mpi ranks into 'out_file_name'
+
+    with 'virtual', the results are not copied but the datasets are HDF5 virtual
+    datasets referring to the slabs in 'filenames', these have to be kept (at the
+    same relative location) until the file is made self-contained with 'compact_results'
+
+    with 'append', 'out_file_name' exists already and the windows are added to it
+    """
 
     global RESULT_ARRAYS, RESULT_FIELDS
 
-    reference_filename = filenames[-1]
+    reference_filename = out_file_name if append else filenames[-1]
     # TODO: should make a sanity check but that has to come later
     if verbose:
         print("using reference file ", reference_filename, "to get the dates, array names, field names and the field shape.")
-    with h5py.File(reference_filename, "r") as in_file:
-        dates = np.array(in_file["data/dates"])
-        RESULT_ARRAYS = list(in_file["data/arrays"])
-        RESULT_FIELDS = list(in_file["data/fields"])
-        if RESULT_FIELDS:
-            field_shape = np.shape(in_file["data/fields"][RESULT_FIELDS[0]])[1:]
-        else:
-            field_shape = ()
+    run_info, dates, RESULT_ARRAYS, RESULT_FIELDS, field_shape = _result_file_info(reference_filename) # keeps the layout, too
 
     np_dates = dates.view(NUMPY_DATE_TYPE)
     # h5py cannot do dates, so this is a workaround
     # http://stackoverflow.com/questions/23570632/store-datetimes-in-hdf5-with-h5py
 
-    prepare_output_file(
-        out_file_name,
-        np_dates,
-        field_shape,
-        run_info={} #TODO: add that properly ... comes with the sanity checks
-    )
+    if not append:
+        prepare_output_file(
+            out_file_name,
+            np_dates,
+            field_shape,
+            run_info=run_info
+        )
     del np_dates, field_shape
 
+    if virtual:
+        assert not append, "virtual datasets can only be created in a new file"
+        assert not delete_after, "the files are needed by the virtual datasets"
+        _merge_virtual(filenames, out_file_name=out_file_name, verbose=verbose)
+        if verbose:
+            print("\nfinished merging\n")
+        return
+
     with h5py.File(out_file_name, "a") as out_file:
-        for filename in filenames:
-            if verbose:
-                print("start merging", filename, "into", out_file_name)
-            with h5py.File(filename, "r") as in_file:
-                assert np.all(dates == in_file["data/dates"])
-                for arrayname in RESULT_ARRAYS:
-                    if verbose:
-                        print("    merging", arrayname)
-                    mask_in_file = ~ np.isnan(in_file["data/arrays"][arrayname])
-                    assert np.all(np.isnan(out_file["data/arrays"][arrayname][mask_in_file])), "overlapping data, how should I merge that?"
-                    out_file["data/arrays"][arrayname][mask_in_file] = in_file["data/arrays"][arrayname][mask_in_file]
-                for fieldname in RESULT_FIELDS:
-                    if verbose:
-                        print("    merging", fieldname)
-                    mask_in_file = ~ np.isnan(in_file["data/fields"][fieldname])
-                    assert np.all(np.isnan(out_file["data/fields"][fieldname][mask_in_file])), "overlapping data, how should I merge that?"
-                    out_file["data/fields"][fieldname][mask_in_file] = in_file["data/fields"][fieldname][mask_in_file]
+        _copy_completed(filenames, out_file, verbose=verbose)
 
     if verbose:
         print("\nfinished merging\n")
@@ -227,7 +520,140 @@ def merge_results(filenames,
 
 
 
-def get_cumulative_distances(graph):
+def _merge_virtual(filenames, *, out_file_name, verbose=1):
+    # replace the datasets created by 'prepare_output_file' by virtual ones
+    assert hasattr(h5py, "VirtualLayout"), "virtual datasets need h5py >= 2.9"
+    out_directory = os.path.dirname(os.path.abspath(out_file_name))
+    with h5py.File(out_file_name, "a") as out_file:
+        out_completed = np.zeros((len(out_file["data/dates"]),), dtype=bool)
+        file_runs = []
+        timing_names = _timing_names(out_file)
+        for filename in filenames:
+            with h5py.File(filename, "r") as in_file:
+                completed = completed_windows(in_file)
+                timing_names = [name for name in timing_names if name in _timing_names(in_file)]
+            assert not np.any(out_completed & completed), "overlapping data, how should I merge that?"
+            out_completed |= completed
+            # relative, so the directory can be moved as a whole
+            file_runs.append((os.path.relpath(os.path.abspath(filename), out_directory), _consecutive_runs(np.flatnonzero(completed))))
+
+        for groupname, names in [("data/arrays", RESULT_ARRAYS), ("data/fields", RESULT_FIELDS), ("timing", timing_names)]:
+            for name in names:
+                if verbose:
+                    print("    merging", name, "(virtual)")
+                path = f"{groupname}/{name}"
+                shape, dtype = out_file[path].shape, out_file[path].dtype
+                del out_file[path]
+                layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+                for filename, runs in file_runs:
+                    source = h5py.VirtualSource(filename, path, shape=shape)
+                    for i0, i1 in runs:
+                        layout[i0:i1] = source[i0:i1]
+                out_file.create_virtual_dataset(path, layout, fillvalue=_fillvalue(dtype))
+        out_file["data/completed"][:] = out_completed
+
+def virtual_source_files(filename):
+    """the files the virtual datasets in 'filename' refer to, relative paths are relative to its directory"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    sources = set()
+    with h5py.File(filename, "r") as in_file:
+        for groupname in ["data/arrays", "data/fields"]:
+            for name in in_file[groupname]:
+                dataset = in_file[groupname][name]
+                if dataset.is_virtual:
+                    sources.update(os.path.join(directory, source.file_name) for source in dataset.virtual_sources())
+    return sorted(sources)
+
+def compact_results(filename, *, verbose=1, delete_sources=False):
+    """copy the data into the virtual datasets of a file merged with 'merge_results(..., virtual=True)'"""
+    sources = virtual_source_files(filename)
+    tmp_file_name = filename + ".compact"
+    merge_results([filename], out_file_name=tmp_file_name, verbose=verbose)
+    os.replace(tmp_file_name, filename)
+    if delete_sources:
+        for source in sources:
+            if verbose:
+                print(f"removing {source} ... ", end="", flush=True)
+            os.remove(source)
+            if verbose:
+                print("done")
+
+def extend_output_file(filename, date_pairs, *, header=None, verbose=1):
+    """
+    grow an output file to the windows in 'date_pairs', the windows of the file have
+    to be the first ones; they are left untouched and the new ones are not completed
+
+    'header' updates the run_info recorded in the file
+    """
+    global RESULT_ARRAYS, RESULT_FIELDS
+
+    run_info, dates, RESULT_ARRAYS, RESULT_FIELDS, field_shape = _result_file_info(filename)
+    num_old = len(dates)
+    assert num_old <= len(date_pairs) and np.all(dates.view(NUMPY_DATE_TYPE) == date_pairs[:num_old]), \
+        f"the windows of '{filename}' are not the first ones of the extended run"
+    assert not virtual_source_files(filename), f"compact '{filename}' first"
+
+    paths = ["data/dates", "data/completed"] + [f"data/arrays/{name}" for name in RESULT_ARRAYS] + [f"data/fields/{name}" for name in RESULT_FIELDS]
+    with h5py.File(filename, "r") as in_file:
+        paths += [f"timing/{name}" for name in _timing_names(in_file)]
+        resizable = all(path in in_file and in_file[path].maxshape[0] is None for path in paths)
+
+    if num_old == len(date_pairs):
+        pass # extended already
+    elif resizable:
+        if verbose:
+            print(f"growing '{filename}' from {num_old} to {len(date_pairs)} windows")
+        with h5py.File(filename, "a") as out_file:
+            for path in paths:
+                out_file[path].resize(len(date_pairs), axis=0) # the new part gets the fill values
+            out_file["data/dates"][num_old:] = date_pairs[num_old:].view(H5PY_DATE_TYPE)
+    else:
+        # contiguous datasets (and files from before) cannot grow, copy into a new file
+        if verbose:
+            print(f"copying '{filename}' to extend it from {num_old} to {len(date_pairs)} windows")
+        tmp_file_name = filename + ".extend"
+        prepare_output_file(tmp_file_name, date_pairs, field_shape, run_info=run_info)
+        with h5py.File(tmp_file_name, "a") as out_file:
+            _copy_completed([filename], out_file, verbose=verbose)
+        os.replace(tmp_file_name, filename)
+
+    if header:
+        with h5py.File(filename, "a") as out_file:
+            for key, value in header.items():
+                out_file["header"].attrs[key] = _header_value(value)
+
+def link_unit_vectors(grid_obj):
+    """the nodes of the grid on the unit sphere as the link lengths need them, computed once per grid"""
+    return grid_obj.exchanged_pointcloud if EXCHANGED_LON_LAT_DISTANCES else grid_obj.pointcloud
+
+def _lon_lat_unit_vectors(lon_lat):
+    lon_lat = np.asarray(lon_lat)
+    if EXCHANGED_LON_LAT_DISTANCES:
+        # lon_lat interpreted as lat_lon, like in the reference
+        return hav.unit_vectors(lon_lat)
+    return hav.unit_vectors(lon_lat[..., ::-1])
+
+def get_cumulative_distances(graph, unit_vectors=None):
+    # unit_vectors are the positions of the nodes on the unit sphere as given by 'link_unit_vectors',
+    # without them they are computed from the "lon_lat" attribute of the graph
+    edges = np.array(graph.get_edgelist(), dtype=int).reshape((-1, 2))
+    if unit_vectors is None:
+        unit_vectors = _lon_lat_unit_vectors(graph.vs["lon_lat"])
+    else:
+        assert len(unit_vectors) == graph.vcount()
+        assert np.allclose(unit_vectors[0], _lon_lat_unit_vectors(graph.vs[0]["lon_lat"])), \
+            "unit_vectors do not fit EXCHANGED_LON_LAT_DISTANCES, use 'link_unit_vectors'"
+
+    dists = hav.unit_vector_distance(unit_vectors[edges[:, 0]], unit_vectors[edges[:, 1]])
+    assert len(graph.es) == len(dists)
+
+    num_v = graph.vcount()
+    cumuDist = np.bincount(edges[:, 0], weights=dists, minlength=num_v)
+    cumuDist += np.bincount(edges[:, 1], weights=dists, minlength=num_v)
+    return cumuDist
+
+def get_cumulative_distances_reference(graph):
+    # the original edge by edge implementation, kept for comparisons
     vs_lon_lats = np.rollaxis(np.array([ [graph.vs[e.source]["lon_lat"][::-1], graph.vs[e.target]["lon_lat"][::-1] ] for e in graph.es ]), 1)
     vs_lat_lons = np.roll(vs_lon_lats, 1, axis=-1) # exchange lon and lat
     del vs_lon_lats
@@ -274,13 +700,15 @@ def get_elnino_maske(graph):
         ##############################################################################################
     return ELNINO_MASK
 
-def get_results(graph):
+def get_results(graph, *, unit_vectors=None, reference=False):
+    # with 'reference', the link lengths are summed up edge by edge like originally (slow, for comparisons)
 
     single_vals = {key: None for key in RESULT_ARRAYS}
     fields = {key: None for key in RESULT_FIELDS}
 
     if "teleconnectivity-field" in fields:
-        fields["teleconnectivity-field"] = get_cumulative_distances(graph) / ((graph.vcount()-1) * hav.HALF_EARTH_CIRCUMFERENCE)
+        cumulative_distances = get_cumulative_distances_reference(graph) if reference else get_cumulative_distances(graph, unit_vectors)
+        fields["teleconnectivity-field"] = cumulative_distances / ((graph.vcount()-1) * hav.HALF_EARTH_CIRCUMFERENCE)
     if "degree-field" in fields:
         fields["degree-field"] = np.array(graph.degree())
 
@@ -326,14 +754,24 @@ def get_results(graph):
             single_vals[MODULARITY_PREFIX + algo_name] = comm_result.modularity
 
     # check everything was generated properly
-    assert None not in list(single_vals.values())
-    assert None not in list(fields.values())
+    assert all(value is not None for value in single_vals.values())
+    assert all(value is not None for value in fields.values())
     assert set(RESULT_ARRAYS).issubset(single_vals)
     assert set(RESULT_FIELDS).issubset(fields)
 
     return single_vals, fields
 
 
+if __name__ == "__main__":
+    # make output files that were merged with virtual datasets self-contained
+    import argparse
 
+    parser = argparse.ArgumentParser(description="compact output files merged with 'fullrun.py --virtual-merge'")
+    parser.add_argument("files", nargs="+", metavar="file")
+    parser.add_argument("--delete-sources", action="store_true",
+                        help="remove the *.mpi-* files afterwards")
+    args = parser.parse_args()
 
-
+    for filename in args.files:
+        print(f"compacting {filename} ... ")
+        compact_results(filename, delete_sources=args.delete_sources)
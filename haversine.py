@@ -35,3 +35,17 @@ def distance(origin, destination,
     d = radius * c
 
     return d
+
+def unit_vectors(lat_lon):
+    # points on the unit sphere, the last axis has to be latitude and longitude (as for 'distance')
+    lat, lon = np.radians(np.rollaxis(np.asarray(lat_lon), -1))
+    return np.stack([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+def unit_vector_distance(origin, destination,
+        radius = EARTH_RADIUS
+        ):
+    # great-circle distance between unit vectors, the last axis holds the 3 components
+    cos_angle = np.einsum("...i,...i->...", origin, destination)
+    return radius * np.arccos(np.clip(cos_angle, -1, 1))
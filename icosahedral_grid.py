@@ -4,12 +4,24 @@ import abstract_grid
 import haversine as hav
 import locations as locs
 
+import hashlib
 import numpy as np
 import igraph as ig
+import scipy.sparse as sparse
 import scipy.spatial as spat
 import os
 
 ICOSAHEDRAL_GRID_CACHE_FILENAME = ".icosahedral-grid.cache.npy"
+ICOSAHEDRAL_GRID_CACHE_FILENAME_TEMPLATE = ".icosahedral-grid-{num_iterations}.cache.npy"
+
+def grid_cache_filename(num_iterations):
+    if num_iterations == 5:
+        # the original cache file name, so existing caches can still be used
+        return ICOSAHEDRAL_GRID_CACHE_FILENAME
+    return ICOSAHEDRAL_GRID_CACHE_FILENAME_TEMPLATE.format(num_iterations=num_iterations)
+
+# the remapping depends on the grid and the base grid, a hash of both is part of the file name
+ICOSAHEDRAL_REMAP_CACHE_FILENAME_TEMPLATE = ".icosahedral-remap-{digest}.cache.npz"
 
 def geodesic_middle(lon_lat1, lon_lat2):
     # from http://stackoverflow.com/questions/4656802/midpoint-between-two-latitude-and-longitude
@@ -209,9 +221,13 @@ class IcosahedralGrid(abstract_grid.AbstractGridObject):
         if verb and not inline_verb:
             print(f"Creating {self.__class__.__name__} ...", end=" ", flush=True)
 
-        assert num_iterations == 5, "the caching is currently only for num_iterations == 5, create an hdf5 cache instead to do more"
+        cache_filename = grid_cache_filename(num_iterations)
 
         self.create_pointcloud = create_pointcloud
+        self.cache = cache
+        self.__remap_indices = None
+        self.__remap_operator = None
+        self.__exchanged_pointcloud = None
 
         n = self.num_iterations = num_iterations
         self.verb = verb
@@ -251,13 +267,13 @@ class IcosahedralGrid(abstract_grid.AbstractGridObject):
         self.graph = None
         self.grid = np.array([])
 
-        # TODO: use hdf5-format for the cache file and save for different numbers of iterations
-        if cache and os.path.exists(ICOSAHEDRAL_GRID_CACHE_FILENAME):
-            if not os.path.isfile(ICOSAHEDRAL_GRID_CACHE_FILENAME):
-                raise IOError("{} not a file".format(ICOSAHEDRAL_GRID_CACHE_FILENAME))
+        # TODO: use hdf5-format for the cache file
+        if cache and os.path.exists(cache_filename):
+            if not os.path.isfile(cache_filename):
+                raise IOError("{} not a file".format(cache_filename))
             if verb:
-                print("loading icosahedral grid from '{}' ... ".format(ICOSAHEDRAL_GRID_CACHE_FILENAME), end="", flush=True)
-            self.grid = np.load(ICOSAHEDRAL_GRID_CACHE_FILENAME)
+                print("loading icosahedral grid from '{}' ... ".format(cache_filename), end="", flush=True)
+            self.grid = np.load(cache_filename)
 
         if keep_graph or not self.grid.size:
             self.graph = IcosahedralGraph(num_iterations=num_iterations)
@@ -266,10 +282,10 @@ class IcosahedralGrid(abstract_grid.AbstractGridObject):
             else:
                 assert np.allclose(self.grid, np.array(self.graph.graph.vs["lon_lat"]))
 
-        if cache and not os.path.exists(ICOSAHEDRAL_GRID_CACHE_FILENAME):
+        if cache and not os.path.exists(cache_filename):
             if verb:
-                print("saving to cache file '{}' ... ".format(ICOSAHEDRAL_GRID_CACHE_FILENAME), end="", flush=True)
-            np.save(ICOSAHEDRAL_GRID_CACHE_FILENAME, self.grid)
+                print("saving to cache file '{}' ... ".format(cache_filename), end="", flush=True)
+            np.save(cache_filename, self.grid)
 
         if not keep_graph:
             self.graph = None # TODO: check that this really frees the memory (it should)
@@ -317,7 +333,15 @@ class IcosahedralGrid(abstract_grid.AbstractGridObject):
     def pointcloud_tree(self):
         return self.__pointcloud_tree
 
-    def _create_pointcloud(self):
+    @property
+    def exchanged_pointcloud(self):
+        # the nodes on the unit sphere with longitude and latitude exchanged,
+        # the link lengths of the published results use these (see 'graph_analysis.EXCHANGED_LON_LAT_DISTANCES')
+        if self.__exchanged_pointcloud is None:
+            self.__exchanged_pointcloud = hav.unit_vectors(self.grid)
+        return self.__exchanged_pointcloud
+
+    def _create_pointcloud(self, with_tree=True):
 
         _grid = np.deg2rad(self.grid)
         self.__pointcloud = np.array([np.cos(_grid[:, 1]) * np.cos(_grid[:, 0]),
@@ -326,13 +350,97 @@ class IcosahedralGrid(abstract_grid.AbstractGridObject):
         del _grid
 
         self.__pointcloud = np.rollaxis(self.__pointcloud, 0, 2)
-        self.__pointcloud_tree = spat.KDTree(self.__pointcloud)
+        self.__pointcloud_tree = spat.KDTree(self.__pointcloud) if with_tree else None
         assert np.allclose(np.linalg.norm(self.__pointcloud, axis=-1), 1)
 
 
 
-    def remap(self, data):
+    NUM_REMAP_NEIGHBORS = 4
+
+    @property
+    def remap_indices(self):
+        # (num_vertices, NUM_REMAP_NEIGHBORS) indices of the closest points of the base grid
+        if self.__remap_indices is None:
+            self.__remap_indices = self._load_or_create_remap_indices()
+        return self.__remap_indices
+
+    @property
+    def remap_operator(self):
+        # sparse (num_vertices, num_base_points) matrix averaging the closest points of the base grid
+        if self.__remap_operator is None:
+            indices = self.remap_indices
+            num_neighbors = indices.shape[1]
+            # the column indices are kept in the order of the query (unsorted), so the sums
+            # are done in the same order as with np.average before and the result is identical
+            self.__remap_operator = sparse.csr_matrix(
+                (np.full(indices.size, 1 / num_neighbors), indices.ravel(), np.arange(0, indices.size + 1, num_neighbors)),
+                shape=(self.grid.shape[0], self.base_grid.shape[0])
+            )
+        return self.__remap_operator
+
+    def _remap_cache_filename(self):
+        digest = hashlib.sha1()
+        for arr in [self.grid, self.base_grid, np.array([self.NUM_REMAP_NEIGHBORS])]:
+            arr = np.ascontiguousarray(arr)
+            digest.update(str((arr.shape, arr.dtype.str)).encode())
+            digest.update(arr.tobytes())
+        return ICOSAHEDRAL_REMAP_CACHE_FILENAME_TEMPLATE.format(digest=digest.hexdigest()[:16])
+
+    def _load_or_create_remap_indices(self):
+        assert self.base_grid is not None, "remapping needs a base grid"
+        cache_filename = self._remap_cache_filename()
+
+        if self.cache and os.path.isfile(cache_filename):
+            with np.load(cache_filename) as cache_file:
+                indices = cache_file["indices"]
+            assert indices.shape == (self.grid.shape[0], self.NUM_REMAP_NEIGHBORS)
+            return indices
+
         assert self.__pointcloud.size and self.__pointcloud_tree is not None, f"did you forget to run '{self.__class__.__name__}.create_pointcloud'?"
+        _, indices = self.tree.query(self.__pointcloud, k=self.NUM_REMAP_NEIGHBORS)
+        if self.cache:
+            # write to a temporary file first, other (mpi) processes might be doing the same
+            tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+            with open(tmp_filename, "wb") as tmp_file:
+                np.savez(tmp_file, indices=indices)
+            os.replace(tmp_filename, cache_filename)
+        return indices
+
+    @classmethod
+    def from_arrays(cls, *,
+                    num_iterations,
+                    grid,
+                    base_grid=None,
+                    num_t=None,
+                    remap_indices=None,
+                    inline_verb=False,
+                    verb=1):
+        """
+        create the grid object from the arrays of an existing one (e.g. received from another mpi process)
+        without loading or generating the grid and without building any kd-tree
+        """
+        assert base_grid is None or num_t is not None, "either give both, base_grid and num_t, or neither"
+        assert (remap_indices is None) or (base_grid is not None), "remap_indices need the base_grid"
+
+        obj = cls.__new__(cls)
+        abstract_grid.AbstractGridObject.__init__(obj)
+        obj.create_pointcloud = True
+        obj.cache = False
+        obj.num_iterations = num_iterations
+        obj.verb = verb
+        obj.inline_verb = inline_verb
+        obj.base_grid = base_grid
+        obj.num_t = num_t
+        obj.tree = None
+        obj.graph = None
+        obj.grid = np.asarray(grid)
+        obj.__remap_indices = remap_indices
+        obj.__remap_operator = None
+        obj.__exchanged_pointcloud = None
+        obj._create_pointcloud(with_tree=False)
+        return obj
+
+    def remap(self, data):
         assert data.shape[0] == self.num_t
         data = np.reshape(data, (self.num_t, data.shape[1] * data.shape[2]))
         assert data.shape[1] == self.base_grid.shape[0]
@@ -342,19 +450,7 @@ class IcosahedralGrid(abstract_grid.AbstractGridObject):
         elif self.verb:
             print("Remapping data ... ", end="")
 
-        num_neighbors = 4
-        _, indices = self.tree.query(self.__pointcloud, k=num_neighbors)
-        #        print(self.grid.shape, self.base_grid.shape, self.pointcloud.shape, data.shape)
-        #        print("grid")
-        #        print(self.grid[100])
-        #        print("indices")
-        #        print(indices[100])
-        #        print("base_grid")
-        #        print(self.base_grid[indices[100], :])
-        #        print(self.pointcloud[0])
-        #        assert False
-
-        newdata = np.average(data[:, indices], axis=-1)  # the last axis are the 'num_neighbors' closest points
+        newdata = self.remap_operator.dot(data.T).T
 
         if self.verb and not self.inline_verb:
             print("done")
@@ -399,8 +495,17 @@ class IcosahedralGrid_PartRemoved(IcosahedralGrid):
 
 
 if __name__ == "__main__":
-    if os.path.isfile(ICOSAHEDRAL_GRID_CACHE_FILENAME):
-        # remove the cache file if it exists
-        os.remove(ICOSAHEDRAL_GRID_CACHE_FILENAME)
-    # (re)create the cache file
-    IcosahedralGrid(5)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="(re)create the cache files of the icosahedral grids")
+    parser.add_argument("num_iterations", metavar="num-iterations", type=int, nargs="*", default=[5],
+                        help="refinement levels of the grids, default: 5")
+    args = parser.parse_args()
+
+    for num_iterations in args.num_iterations:
+        cache_filename = grid_cache_filename(num_iterations)
+        if os.path.isfile(cache_filename):
+            # remove the cache file if it exists
+            os.remove(cache_filename)
+        # (re)create the cache file
+        IcosahedralGrid(num_iterations)
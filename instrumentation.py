@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+
+import contextlib
+import functools as ft
+import json
+import os
+import resource
+import threading
+import time
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+# the stages of a window in the order they run (see fullrun.compute_edges and fullrun.compute_metrics)
+TIMING_STAGES = ["load", "correlation", "threshold", "graph", "metrics"]
+TIMING_QUANTITIES = ["wall-time", "cpu-time", "bytes-read", "bytes-written"]
+# the datasets in the 'timing' group of the output file, one value per window
+TIMING_DATASETS = [f"{stage}-{quantity}" for stage in TIMING_STAGES for quantity in TIMING_QUANTITIES] + ["max-rss", "rank"]
+
+TIMING_LOG_SUFFIX = ".timing.jsonl"
+
+
+def io_counters():
+    """bytes read from and written to the storage by this process, zeros where /proc/self/io is not available"""
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            counters = dict(line.split(":") for line in io_file if ":" in line)
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def max_rss():
+    """peak resident set size of this process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+
+
+@contextlib.contextmanager
+def measure(values, name):
+    # add the wall and cpu time and the bytes read and written of the block to values[f"{name}-..."]
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    read0, written0 = io_counters()
+    try:
+        yield
+    finally:
+        read1, written1 = io_counters()
+        for quantity, value in zip(TIMING_QUANTITIES, [time.perf_counter() - wall0, time.process_time() - cpu0, read1 - read0, written1 - written0]):
+            key = f"{name}-{quantity}"
+            values[key] = values.get(key, 0) + value
+
+
+class WindowTiming(object):
+    """
+    the instrumentation of the stages of one window, it is passed along with the
+    window (e.g. to the metric workers) and written together with its results
+
+    the cpu time is the one of the whole process, so it includes other threads (BLAS, the writer, ...)
+    """
+
+    def __init__(self, index, *, rank=0):
+        self.index = index
+        self.rank = rank
+        self.pid = os.getpid()
+        self.values = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        assert name in TIMING_STAGES, f"unknown stage {name!r}"
+        with measure(self.values, name):
+            yield
+        self.values["max-rss"] = max_rss()
+
+    def record(self):
+        """the values for the 'timing' group of the output file and the log"""
+        return dict(self.values, rank=self.rank, pid=self.pid, index=self.index)
+
+
+class TimingLog(object):
+    """appends timing records to a file as json lines, from several threads"""
+
+    def __init__(self, filename, *, rank=0):
+        self.filename = filename
+        self.rank = rank # for the records without one, e.g. of the writing
+        self.lock = threading.Lock()
+        self.log_file = open(filename, "a")
+
+    def write(self, record, *, kind):
+        line = json.dumps(dict({"rank": self.rank}, **record, kind=kind, time=time.time()), sort_keys=True)
+        with self.lock:
+            self.log_file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.log_file.close()
+
+
+def profiled_windows(iterator, profiler, *, max_windows):
+    """
+    iterate over 'iterator' with the (cProfile) profiler enabled while the
+    loop body runs, for the first 'max_windows' items only
+    """
+    for num, item in enumerate(iterator):
+        if num >= max_windows:
+            yield item
+            continue
+        profiler.enable()
+        try:
+            yield item
+        finally:
+            profiler.disable()
+
+
+def merge_profiles(filenames, *, out_file_name, report_file_name, num_lines=60):
+    """merge the profiles of the processes into one, written to 'out_file_name' and as text to 'report_file_name'"""
+    import pstats
+
+    stats = None
+    merged_filenames = []
+    for filename in filenames:
+        try:
+            file_stats = pstats.Stats(filename)
+        except (OSError, TypeError): # missing or nothing profiled, e.g. the master of the dynamic schedule
+            continue
+        if stats is None:
+            stats = file_stats
+        else:
+            stats.add(file_stats)
+        merged_filenames.append(filename)
+    if stats is None:
+        return False
+    stats.dump_stats(out_file_name)
+    with open(report_file_name, "w") as report_file:
+        report_file.write("merged profile of:\n" + "".join(f"    {filename}\n" for filename in merged_filenames) + "\n")
+        stats = pstats.Stats(out_file_name, stream=report_file)
+        stats.sort_stats("cumulative").print_stats(num_lines)
+        stats.sort_stats("tottime").print_stats(num_lines)
+    return True
+
+
+def read_timing_log(filename):
+    with open(filename, "r") as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def read_timing_group(filename):
+    """the timing records of the completed windows of an output file"""
+    import graph_analysis as ga
+    import h5py
+    import numpy as np
+
+    with h5py.File(filename, "r") as in_file:
+        if "timing" not in in_file:
+            return []
+        completed = ga.completed_windows(in_file)
+        columns = {name: np.array(in_file["timing"][name]) for name in in_file["timing"]}
+    records = []
+    for index in np.flatnonzero(completed):
+        record = {name: float(values[index]) for name, values in columns.items() if not np.isnan(values[index])}
+        if record:
+            record.update(index=int(index), kind="window")
+            records.append(record)
+    return records
+
+
+def stage_table(records):
+    """one row per (rank, stage) and window (or written batch)"""
+    import pandas as pd
+
+    rows = []
+    for record in records:
+        if record.get("kind") == "write":
+            stages = ["write"]
+        else:
+            stages = [stage for stage in TIMING_STAGES if f"{stage}-wall-time" in record]
+        for stage in stages:
+            row = {"rank": int(record.get("rank", 0)), "stage": stage}
+            row.update({quantity: record.get(f"{stage}-{quantity}", 0.) for quantity in TIMING_QUANTITIES})
+            row["max-rss"] = record.get("max-rss", float("nan"))
+            rows.append(row)
+    return pd.DataFrame(rows, columns=["rank", "stage", "max-rss"] + TIMING_QUANTITIES)
+
+
+def summarize(records, *, by_rank=True):
+    """totals and means of the stages (by rank), the peak memory is the maximum over the windows"""
+    table = stage_table(records)
+    keys = ["rank", "stage"] if by_rank else ["stage"]
+    grouped = table.groupby(keys, sort=True)
+    summary = grouped[TIMING_QUANTITIES].sum()
+    summary.insert(0, "count", grouped.size())
+    summary.insert(2, "mean-wall-time", grouped["wall-time"].mean())
+    summary["max-rss-MB"] = grouped["max-rss"].max() / 2**20
+    return summary
+
+
+if __name__ == "__main__":
+    # summarize the timing of runs by rank and stage
+    import argcomplete, argparse
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="summarize the timing of fullrun.py by rank and stage, "
+                                     "from the json lines logs (*" + TIMING_LOG_SUFFIX + ") or the 'timing' group of output files")
+    parser.add_argument("files", nargs="+", metavar="file")
+    parser.add_argument("--by-stage", action="store_false", dest="by_rank",
+                        help="summarize all ranks together")
+
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    records = []
+    for filename in args.files:
+        if filename.endswith(".jsonl"):
+            records.extend(read_timing_log(filename))
+        else:
+            records.extend(read_timing_group(filename))
+    if not records:
+        parser.error("no timing records found")
+
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200, "display.float_format", "{:0.3f}".format):
+        print(summarize(records, by_rank=args.by_rank))
@@ -0,0 +1,50 @@
+
+import collections
+import concurrent.futures
+import functools as ft
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+
+def run_pipeline(items, *,
+                 first_stage,
+                 second_stage,
+                 handle_result,
+                 executor,
+                 depth):
+    """
+    overlap two stages of the computation for 'items':
+
+    first_stage(item) runs in this thread, one item after another and in order
+    (e.g. because it keeps state between consecutive items), while
+    second_stage(*first_result) runs concurrently in 'executor' for the items before
+
+    at most 'depth' items are in the second stage (waiting or running), so the first
+    stage blocks instead of piling up results; handle_result(item, second_result)
+    is called in this thread in the order the second stage finishes
+    """
+    assert depth > 0
+    pending = collections.OrderedDict() # future -> item
+
+    def handle_done(wait_for_one):
+        if not pending:
+            return
+        done, _ = concurrent.futures.wait(
+            list(pending),
+            timeout=None if wait_for_one else 0,
+            return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in [future for future in pending if future in done]:
+            item = pending.pop(future)
+            handle_result(item, future.result())
+
+    for item in items:
+        first_result = first_stage(item)
+        handle_done(wait_for_one=False)
+        while len(pending) >= depth:
+            handle_done(wait_for_one=True)
+        pending[executor.submit(second_stage, *first_result)] = item
+
+    while pending:
+        handle_done(wait_for_one=True)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+
+from data_loader import NCEP_NCAR
+from dates import isleap
+import haversine as hav
+
+import functools as ft
+import netCDF4
+import numpy as np
+import os
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+# the NCEP/NCAR reanalysis grid, 2.5 degrees from the north pole and the 0 meridian
+SYNTHETIC_LAT = np.linspace(90., -90., NCEP_NCAR.grid_shape[0], dtype=np.float32)
+SYNTHETIC_LON = np.linspace(0., 357.5, NCEP_NCAR.grid_shape[1], dtype=np.float32)
+
+# centers (lat, lon, sign) of the teleconnection patterns, each is driven by its own slow index
+TELECONNECTION_PATTERNS = {
+    # El Nino: eastern tropical Pacific against the maritime continent
+    "enso" : [(0., 235., +1.), (-5., 120., -1.)],
+    # North Atlantic Oscillation: Iceland against the Azores
+    "nao"  : [(65., 340., +1.), (38., 335., -1.)],
+    # Pacific North American pattern
+    "pna"  : [(20., 200., +1.), (45., 195., -1.), (55., 245., +1.), (30., 275., -1.)],
+    # Antarctic Oscillation: a ring around the pole against the mid latitudes
+    "aao"  : [(-70., lon, +1.) for lon in range(0, 360, 60)] + [(-40., lon, -1.) for lon in range(30, 390, 60)],
+}
+
+
+def pattern_loading(centers, *, width, lat=SYNTHETIC_LAT, lon=SYNTHETIC_LON):
+    """the spatial pattern: gaussian blobs (in great circle distance, degrees) around the signed centers"""
+    grid = hav.unit_vectors(np.stack(np.meshgrid(lat, lon, indexing="ij"), axis=-1))
+    loading = np.zeros(grid.shape[:-1])
+    for center_lat, center_lon, sign in centers:
+        center = hav.unit_vectors(np.array([center_lat, center_lon]))
+        angle = np.degrees(np.arccos(np.clip(grid @ center, -1., 1.)))
+        loading += sign * np.exp(-0.5 * (angle / width)**2)
+    return loading
+
+
+def smoothing_operators(*, correlation_length, lat=SYNTHETIC_LAT, lon=SYNTHETIC_LON):
+    """
+    normalized gaussian smoothing along latitude (a matrix) and along the periodic longitude
+    (in fourier space, wider towards the poles), giving the noise a spatial correlation length in degrees
+    """
+    lat_distance = lat[:, None] - lat[None, :]
+    lat_kernel = np.exp(-0.5 * (lat_distance / correlation_length)**2)
+    lat_kernel /= np.sqrt((lat_kernel**2).sum(1, keepdims=True))
+
+    lon_step = 360. / len(lon)
+    wave_numbers = np.fft.rfftfreq(len(lon), d=lon_step)
+    # the distance of a degree of longitude shrinks with cos(lat), at the poles everything is smoothed
+    lon_length = correlation_length / np.maximum(np.cos(np.radians(lat)), 1e-2)
+    lon_filter = np.exp(-2. * (np.pi * wave_numbers[None, :] * lon_length[:, None])**2)
+    lon_filter /= np.sqrt((lon_filter**2).sum(1, keepdims=True) * 2. / len(lon))
+    return lat_kernel, lon_filter
+
+
+class SyntheticAirTemperature(object):
+    """
+    daily near surface air temperature like 'air.sig995' on the NCEP/NCAR grid:
+    a climatology with a seasonal cycle, spatially correlated AR(1) anomalies and
+    the teleconnection patterns, each driven by a slow AR(1) index
+
+    the years have to be generated in order, the state of the processes is carried over
+    """
+
+    def __init__(self, *,
+                 patterns=tuple(TELECONNECTION_PATTERNS),
+                 pattern_amplitude=3.,
+                 pattern_width=12.,
+                 pattern_memory=0.98,
+                 noise_amplitude=2.,
+                 noise_memory=0.7,
+                 correlation_length=7.5,
+                 seed=0):
+        assert set(patterns).issubset(TELECONNECTION_PATTERNS), f"unknown patterns {set(patterns) - set(TELECONNECTION_PATTERNS)}"
+        self.random = np.random.default_rng(seed)
+        self.loadings = np.array([pattern_loading(TELECONNECTION_PATTERNS[name], width=pattern_width) for name in patterns]).reshape((len(patterns),) + NCEP_NCAR.grid_shape)
+        self.pattern_amplitude = pattern_amplitude
+        self.pattern_memory = pattern_memory
+        self.noise_amplitude = noise_amplitude
+        self.noise_memory = noise_memory
+        self.lat_kernel, self.lon_filter = smoothing_operators(correlation_length=correlation_length)
+
+        lat = np.radians(SYNTHETIC_LAT)[:, None]
+        self.mean = 250. + 50. * np.cos(lat)**2 * np.ones(NCEP_NCAR.grid_shape) # degK
+        self.seasonal_amplitude = 15. * np.sin(lat) * np.ones(NCEP_NCAR.grid_shape) # opposite on the hemispheres
+
+        # stationary initial states
+        self.indices = self.random.standard_normal(len(patterns))
+        self.noise = self._smooth_noise(1)[0]
+
+    def _smooth_noise(self, num_days):
+        white = self.random.standard_normal((num_days,) + NCEP_NCAR.grid_shape)
+        smooth = np.einsum("ij,tjk->tik", self.lat_kernel, white)
+        smooth = np.fft.irfft(np.fft.rfft(smooth, axis=-1) * self.lon_filter, n=NCEP_NCAR.grid_shape[1], axis=-1)
+        return smooth
+
+    def _ar1(self, state, memory, innovations):
+        # unit variance AR(1) process, innovations along the first axis
+        series = np.empty_like(innovations)
+        scale = np.sqrt(1. - memory**2)
+        for t, innovation in enumerate(innovations):
+            state = memory * state + scale * innovation
+            series[t] = state
+        return series, state
+
+    def year(self, year):
+        """the data (days, lat, lon) of a year, 366 days in leap years"""
+        num_days = 366 if isleap(year) else 365
+        day_of_year = np.arange(num_days)
+
+        indices, self.indices = self._ar1(self.indices, self.pattern_memory, self.random.standard_normal((num_days, len(self.indices))))
+        noise, self.noise = self._ar1(self.noise, self.noise_memory, self._smooth_noise(num_days))
+
+        seasonal_cycle = np.cos(2. * np.pi * (day_of_year - 200.) / num_days)
+        data = self.mean[None] + seasonal_cycle[:, None, None] * self.seasonal_amplitude[None]
+        data += self.noise_amplitude * noise
+        data += self.pattern_amplitude * np.einsum("tp,pij->tij", indices, self.loadings)
+        return data.astype(np.float32)
+
+
+def write_year(filename, data, *, year, base_name="air"):
+    """write the data of a year with the layout of the NCEP/NCAR files, as expected by 'DataLoader.load_base'"""
+    assert data.shape[1:] == NCEP_NCAR.grid_shape
+    with netCDF4.Dataset(filename, "w", format="NETCDF4_CLASSIC") as out_file:
+        out_file.createDimension("time", None) # unlimited, MFDataset aggregates along it
+        out_file.createDimension("lat", NCEP_NCAR.grid_shape[0])
+        out_file.createDimension("lon", NCEP_NCAR.grid_shape[1])
+
+        time = out_file.createVariable("time", "f8", ("time",))
+        time.units = "hours since 1800-01-01 00:00:0.0"
+        first_hour = (np.datetime64(f"{year}-01-01") - np.datetime64("1800-01-01")).astype(int) * 24
+        time[:] = first_hour + 24. * np.arange(data.shape[0])
+
+        lat = out_file.createVariable("lat", "f4", ("lat",))
+        lat.units = "degrees_north"
+        lat[:] = SYNTHETIC_LAT
+        lon = out_file.createVariable("lon", "f4", ("lon",))
+        lon.units = "degrees_east"
+        lon[:] = SYNTHETIC_LON
+
+        values = out_file.createVariable(base_name, "f4", ("time", "lat", "lon"))
+        values.units = "degK"
+        values[:] = data
+
+        out_file.title = "synthetic data with the layout of the NCEP/NCAR reanalysis, created by synthetic_data.py"
+
+
+def generate(data_directory, *, begin_year, end_year, base_name="air", verbose=1, **options):
+    """write the files of the years into 'data_directory', see 'SyntheticAirTemperature' for the options"""
+    generator = SyntheticAirTemperature(**options)
+    filenames = []
+    for year in range(begin_year, end_year + 1):
+        if verbose:
+            print(f"({year}) ", end="")
+        filename = os.path.join(data_directory, NCEP_NCAR.file_strings[base_name].format(year=year))
+        write_year(filename, generator.year(year), year=year, base_name=base_name)
+        filenames.append(filename)
+    if verbose:
+        print("done")
+    return filenames
+
+
+if __name__ == "__main__":
+    import argcomplete, argparse
+
+    parser = argparse.ArgumentParser(description="write synthetic air temperature files with the layout of the NCEP/NCAR reanalysis, "
+                                     "e.g. for running and timing fullrun.py without the real data")
+    parser.add_argument("data_directory", metavar="data-directory",
+                        help="where the files are written, the same file names as the real data are used")
+    parser.add_argument("--begin-year", type=int, default=NCEP_NCAR.begin_year, metavar="year",
+                        help="default: {}".format(NCEP_NCAR.begin_year))
+    parser.add_argument("--end-year", type=int, default=NCEP_NCAR.end_year, metavar="year",
+                        help="default: {} (fullrun.py uses all years for the daily means)".format(NCEP_NCAR.end_year))
+    parser.add_argument("--patterns", nargs="*", choices=sorted(TELECONNECTION_PATTERNS), default=sorted(TELECONNECTION_PATTERNS),
+                        help="the teleconnection patterns put into the data, default: all")
+    parser.add_argument("--pattern-amplitude", type=float, default=3., metavar="K",
+                        help="standard deviation of the patterns at their centers, default: 3 K")
+    parser.add_argument("--noise-amplitude", type=float, default=2., metavar="K",
+                        help="standard deviation of the local anomalies, default: 2 K")
+    parser.add_argument("--correlation-length", type=float, default=7.5, metavar="degrees",
+                        help="spatial correlation length of the local anomalies, default: 7.5 degrees")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random numbers, default: 0")
+
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    if args.begin_year > args.end_year:
+        parser.error("the begin year is after the end year")
+    os.makedirs(args.data_directory, exist_ok=True)
+
+    print(f"writing synthetic data to '{args.data_directory}' ... ", end="")
+    generate(
+        args.data_directory,
+        begin_year=args.begin_year,
+        end_year=args.end_year,
+        patterns=args.patterns,
+        pattern_amplitude=args.pattern_amplitude,
+        noise_amplitude=args.noise_amplitude,
+        correlation_length=args.correlation_length,
+        seed=args.seed
+    )
@@ -0,0 +1,61 @@
+
+import functools as ft
+import numpy as np
+
+# always flush print output
+print = ft.partial(print, flush=True)
+
+# separates the scheduling messages from the other communication of fullrun.py
+SCHEDULE_TAG = 17
+DEFAULT_MIN_CHUNK_SIZE = 8
+
+
+def guided_chunks(num_windows, num_workers, *, min_chunk_size=DEFAULT_MIN_CHUNK_SIZE, factor=2):
+    """
+    (begin, end) of consecutive windows in the order they are handed out, each chunk is
+    1/(factor * num_workers) of the remaining windows, so they get smaller towards the end
+    """
+    assert num_workers > 0
+    assert min_chunk_size > 0
+    begin = 0
+    while begin < num_windows:
+        remaining = num_windows - begin
+        chunk_size = max(min_chunk_size, int(np.ceil(remaining / (factor * num_workers))))
+        end = min(begin + chunk_size, num_windows)
+        yield begin, end
+        begin = end
+
+
+def serve_windows(work, *, comm, num_workers, min_chunk_size=DEFAULT_MIN_CHUNK_SIZE):
+    """
+    run on the master: hand out chunks of consecutive items of 'work' to the workers
+    (ranks 1 ... num_workers) whenever they ask for it, until everything is done
+    """
+    from mpi4py import MPI
+
+    chunks = guided_chunks(len(work), num_workers, min_chunk_size=min_chunk_size)
+    num_handed_out = [0] * (num_workers + 1)
+    active_workers = num_workers
+    status = MPI.Status()
+    while active_workers:
+        comm.recv(source=MPI.ANY_SOURCE, tag=SCHEDULE_TAG, status=status)
+        worker = status.Get_source()
+        chunk = next(chunks, None)
+        if chunk is None:
+            comm.send(None, dest=worker, tag=SCHEDULE_TAG) # nothing left, the worker stops
+            active_workers -= 1
+        else:
+            begin, end = chunk
+            comm.send(work[begin:end], dest=worker, tag=SCHEDULE_TAG)
+            num_handed_out[worker] += end - begin
+    print("windows per worker:", ", ".join(f"{worker}: {num}" for worker, num in enumerate(num_handed_out) if worker))
+
+
+def requested_windows(*, comm, master=0):
+    """run on the workers: iterate over the items the master hands out"""
+    while True:
+        comm.send("ready", dest=master, tag=SCHEDULE_TAG)
+        chunk = comm.recv(source=master, tag=SCHEDULE_TAG)
+        if chunk is None:
+            return
+        yield from chunk